@@ -21,6 +21,20 @@ def create_app(config_name = 'development'):
     db.init_app(app)
     alexa.init_app(app)
 
+    from .utils.metrics import metrics
+    metrics.init_app(app)
+
+    from .utils import recipes
+    recipes.init_app(app)
+
+    from . import dialog
+    dialog.init_app(app)
+
+    from .persistence import init_db, state_writer, pruner
+    init_db(app)
+    state_writer.init_app(app)
+    pruner.init_app(app)
+
     from . import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
@@ -1,6 +1,92 @@
 from flask_ask import session
 
-from .utils.recipes import all_recipes
+from .utils.cache import LRUCache
+from .utils.recipes import recipe_store, cursor_size, generation
+
+
+class RenderedRecipe(object):
+    '''
+        Everything we say or show about a recipe, rendered once (UTF-8):
+        offer           the question in the search state
+        prepare         the ingredients in the prepare state, by step (groups of 4)
+        cook            the cooking steps
+        title, card     the card sent with the recipe
+    '''
+    __slots__ = ('offer', 'prepare', 'cook', 'title', 'card')
+
+    def __init__(self, recipe):
+        offer = u'Do you want to cook {}?'.format(recipe.title)
+        if recipe.categories:
+            offer += u' It\'s a {}.'.format(u', '.join(recipe.categories))
+        self.offer = offer.encode('utf-8')
+
+        # Prepare lists up to 4 lines of ingredients
+        # for the user to check whether he has them.
+        lines = recipe.ingredient_lines
+        self.prepare = []
+        for step in range(0, len(lines), 4):
+            ingredients = lines[step:step+4]
+            if step == 0:
+                answer = u'This recipe requires the following {} ingredients: '.format(len(lines))
+            else:
+                answer = u'Next you\'ll need '
+
+            if len(ingredients) > 1:
+                answer += u', '.join(ingredients[:-1])
+                answer += u' and ' + ingredients[-1]
+            else:
+                answer += ingredients[0]
+
+            answer += u'. Do you have these ingredients?'
+            self.prepare.append(answer.encode('utf-8'))
+
+        # Cook walks through the cooking instructions
+        self.cook = []
+        for step, instruction in enumerate(recipe.steps):
+            if step == 0:
+                answer = u'Let\'s get started! '
+            else:
+                answer = u''
+            answer += u' Step {}: '.format(step+1)
+            answer += instruction
+
+            # Need instructions
+            answer += u'. When you\'re done use: alexa, next.'
+            self.cook.append(answer.encode('utf-8'))
+
+        text = u'INGREDIENTS'
+        text += u'\n'.join([r.capitalize() + '.' for r in lines])
+        text += u'\nDIRECTIONS'
+        text += u'\n'.join([r.capitalize() + '.' for r in recipe.steps])
+
+        if recipe.author:
+            text += u'\nSubmitted by {} on recipes.wikia.com.'.format(recipe.author)
+        else:
+            text += u'Recipe from recipes.wikia.com.'
+
+        self.title = recipe.title.encode('utf-8')
+        self.card = text.encode('utf-8')
+
+
+# Rendered recipes by generation and stable id (the ones currently being cooked)
+rendered = LRUCache(512)
+
+
+def init_app(app):
+    rendered.maxsize = app.config['RENDER_CACHE_SIZE']
+    rendered.clear()
+
+
+def render(i):
+    '''
+        returns: the RenderedRecipe of recipe i (cached)
+    '''
+    key = generation().number, i
+    recipe = rendered.get(key)
+    if recipe is None:
+        recipe = RenderedRecipe(recipe_store[i])
+        rendered.put(key, recipe)
+    return recipe
 
 
 def reply():
@@ -13,76 +99,33 @@ def reply():
     sess = session.attributes
     state = sess.get('state')
     if not state:
-        answer = u'Please restart the app!'
+        answer = 'Please restart the app!'
 
     elif state == 'ingredients':
-        answer = u'Add more ingredients or search for recipes.'
+        answer = 'Add more ingredients or search for recipes.'
 
     elif state == 'search':
-        recipe = all_recipes[sess['recipe']]
-        answer = u''
-        if sess['recipe'] == sess['recipe_list'][0]:
-            answer = u'Found {} recipes. '.format(len(sess['recipe_list']))
+        answer = render(sess['recipe']).offer
+        cursor = sess['recipe_list']
+        if cursor['position'] == 0 and cursor.get('ranked'):
+            answer = 'No recipe uses all your ingredients, here are the {} closest. '.format(cursor_size(cursor)) + answer
+        elif cursor['position'] == 0:
+            answer = 'Found {} recipes. '.format(cursor_size(cursor)) + answer
 
-        answer += u'Do you want to cook {}?'.format(recipe[0])
-        if recipe[3]:
-            answer += u' It\'s a {}.'.format(recipe[3])
-
-    # Prepare lists up to 3 lines of ingredients
-    # for the user to check whether he has them.
     elif state == 'prepare':
+        prepare = render(sess['recipe']).prepare
         step = sess['step']
-        recipe = all_recipes[sess['recipe']]
-        ingredients = recipe[1][0][step:step+4]
-
-        answer = u''
-        if step == 0:
-            answer = u'This recipe requires the following {} ingredients: '.format(len(recipe[1][0]))
-        else:
-            answer = u'Next you\'ll need '
-
-        if len(ingredients) > 1:
-            answer += u', '.join(ingredients[:-1])
-            answer += u' and ' + ingredients[-1]
-        elif len(ingredients) == 1:
-            answer += ingredients[0]
+        if step % 4 == 0 and step // 4 < len(prepare):
+            answer = prepare[step // 4]
         else:
-            print ingredients
-            print 'whyyy?'
             return 'Are you ready to cook?'
 
-        answer += u'. Do you have these ingredients?'
-
-    # Cook walks through the cooking instructions
     elif state == 'cook':
-        step = sess['step']
-        recipe = all_recipes[sess['recipe']]
+        answer = render(sess['recipe']).cook[sess['step']]
 
-        if step == 0:
-            answer = u'Let\'s get started! '
-        else:
-            answer = u''
-        answer += u' Step {}: '.format(step+1)
-        answer += recipe[2][step]
-
-        # Need instructions
-        answer += '. When you\'re done use: alexa, next.'
-
-
-    return answer.encode('utf-8')
+    return answer
 
 
 def recipe_card():
-    recipe = all_recipes[session.attributes['recipe']]
-
-    text = u'INGREDIENTS'
-    text += u'\n'.join([r.capitalize() + '.' for r in recipe[1][0]])
-    text += u'\nDIRECTIONS'
-    text += u'\n'.join([r.capitalize() + '.' for r in recipe[2]])
-
-    if recipe[5]:
-        text += u'\nSubmitted by {} on recipes.wikia.com.'.format(recipe[5])
-    else:
-        text += u'Recipe from recipes.wikia.com.'
-
-    return {'title': recipe[0], 'content': text}
\ No newline at end of file
+    recipe = render(session.attributes['recipe'])
+    return {'title': recipe.title, 'content': recipe.card}
@@ -9,12 +9,12 @@ class User(db.Model):
     user_id = db.Column(db.String(512), unique=True, primary_key=True)
 
     # The state machine (so we can pick up exactly where we left off)
-    # A cheap pickle type for now
-    state_machine = db.Column(db.PickleType)
+    # Encoded with utils.state.encode_state(), older rows are pickles
+    state_machine = db.Column(db.LargeBinary)
 
     # Some stats
     joined = db.Column(db.DateTime, unique=False)
-    last_online = db.Column(db.DateTime, unique=False)
+    last_online = db.Column(db.DateTime, unique=False, index=True)
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
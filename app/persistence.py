@@ -0,0 +1,465 @@
+import atexit
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+from sqlalchemy import event, text, bindparam
+
+from . import db
+from .models import User
+from .utils.cache import LRUCache
+from .utils.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Create or update users in a single statement (SQLite >= 3.24, PostgreSQL)
+UPSERT = text('''
+    INSERT INTO users (user_id, state_machine, joined, last_online)
+    VALUES (:user_id, :state_machine, :last_online, :last_online)
+    ON CONFLICT (user_id) DO UPDATE SET
+        state_machine = excluded.state_machine,
+        last_online = excluded.last_online
+''').bindparams(
+    bindparam('state_machine', type_=db.LargeBinary),
+    bindparam('last_online', type_=db.DateTime),
+)
+
+
+# Users not online since :cutoff, a batch at a time (see prune_users())
+DELETE_IDLE = text('''
+    DELETE FROM users WHERE user_id IN (
+        SELECT user_id FROM users WHERE last_online < :cutoff LIMIT :limit)
+''').bindparams(bindparam('cutoff', type_=db.DateTime))
+
+RESET_IDLE = text('''
+    UPDATE users SET state_machine = NULL WHERE user_id IN (
+        SELECT user_id FROM users WHERE last_online < :cutoff AND state_machine IS NOT NULL LIMIT :limit)
+''').bindparams(bindparam('cutoff', type_=db.DateTime))
+
+# Databases created before last_online was indexed
+LAST_ONLINE_INDEX = text('CREATE INDEX IF NOT EXISTS ix_users_last_online ON users (last_online)')
+
+
+def supports_upsert(uri):
+    if uri.startswith('sqlite'):
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return uri.startswith('postgres')
+
+
+def init_db(app):
+    '''
+        Apply SQLITE_PRAGMAS (e.g. WAL) to every new connection
+        and measure the time spent in queries (if metrics are enabled)
+    '''
+    engine = db.get_engine(app)
+
+    if app.config['METRICS_SAMPLE']:
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_query(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault('query_start', []).append(time.time())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def end_query(connection, cursor, statement, parameters, context, executemany):
+            metrics.observe('foodworld_db_seconds', time.time() - connection.info['query_start'].pop())
+
+    pragmas = app.config['SQLITE_PRAGMAS']
+    if not pragmas or not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+
+class StateWriter(object):
+    '''
+        Persists the (encoded) state machine of the users.
+
+        Synchronous by default: every save is committed right away.
+        With PERSIST_WRITE_BEHIND the latest state per user is kept in memory
+        and a background thread writes all dirty users in one transaction,
+        every PERSIST_FLUSH_INTERVAL seconds or as soon as PERSIST_FLUSH_SIZE
+        users are dirty. If PERSIST_MAX_PENDING users are dirty the request
+        saving a state flushes itself (backpressure). Pending states are
+        flushed on shutdown, or explicitly using flush().
+
+        States are cached per process (USER_CACHE_SIZE users, dropped after
+        USER_CACHE_IDLE seconds without use). With USER_CACHE_VALIDATE a hit
+        is checked against the last_online of the row (another worker may
+        have written a newer state), which is a lot cheaper than loading it.
+        A single worker can skip this and serve hits without any query.
+    '''
+    # SQLite limits the number of variables in a query (user_id IN (...))
+    batch_size = 500
+
+    def __init__(self, app=None):
+        self.app = None
+        self.write_behind = False
+        self.pending = {}
+        self.pid = None
+        self.thread = None
+        self.running = False
+        self.start_worker()
+
+        self.upsert = False
+        self.cache = None
+        self.validate = True
+        self.stale = 0
+        self.loads_avoided = 0
+        self.queries_avoided = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.write_behind = app.config['PERSIST_WRITE_BEHIND']
+        self.flush_interval = app.config['PERSIST_FLUSH_INTERVAL']
+        self.flush_size = app.config['PERSIST_FLUSH_SIZE']
+        self.max_pending = app.config['PERSIST_MAX_PENDING']
+        self.upsert = app.config['PERSIST_UPSERT'] and supports_upsert(app.config['SQLALCHEMY_DATABASE_URI'])
+
+        self.cache = LRUCache(app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_IDLE'], idle=True)
+        self.validate = app.config['USER_CACHE_VALIDATE']
+
+        if self.write_behind:
+            atexit.register(self.stop)
+
+    def load(self, user_id):
+        '''
+            returns: the encoded state of a user or None (new user or no state)
+        '''
+        with self.lock:
+            pending = self.pending.get(user_id)
+        if pending is not None:
+            return pending[0]
+
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            state, last_online = cached
+            if not self.validate:
+                self.queries_avoided += 1
+                return state
+
+            row = db.session.query(User.last_online).filter(User.user_id == user_id).first()
+            if row is not None and row[0] == last_online:
+                self.loads_avoided += 1
+                return state
+
+            # Somebody else wrote a newer state
+            self.stale += 1
+            self.cache.pop(user_id)
+
+        row = db.session.query(User.state_machine, User.last_online).filter(User.user_id == user_id).first()
+        if row is None:
+            return None
+
+        self.cache.put(user_id, tuple(row))
+        return row[0]
+
+    def save(self, user_id, state):
+        '''
+            Save the encoded state of a user (and mark the user as online)
+        '''
+        now = datetime.now()
+        self.cache.put(user_id, (state, now))
+        if not self.write_behind:
+            self.write({user_id: (state, now)})
+            return
+
+        # Not started in this process yet (without gunicorn)
+        if self.pid != os.getpid():
+            self.start_worker()
+
+        with self.lock:
+            self.pending[user_id] = (state, now)
+            n_pending = len(self.pending)
+            started = self.thread is not None
+            if started and n_pending >= self.flush_size:
+                self.wakeup.notify()
+
+        # Not holding the lock: starting a thread may switch to it (gevent)
+        if not started:
+            self.start()
+
+        # Backpressure: too much is waiting, write it ourselves
+        if n_pending >= self.max_pending:
+            self.flush()
+
+    def write(self, states):
+        '''
+            Write states {user_id: (state, last online)} in one transaction,
+            creating users as needed.
+        '''
+        if self.upsert:
+            db.session.execute(UPSERT, [
+                {'user_id': user_id, 'state_machine': state, 'last_online': last_online}
+                for user_id, (state, last_online) in states.items()
+            ])
+        else:
+            self.write_orm(states)
+
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def write_orm(self, states):
+        '''
+            Get-then-add, for databases without upsert
+        '''
+        user_ids = list(states)
+        for i in range(0, len(user_ids), self.batch_size):
+            batch = user_ids[i:i + self.batch_size]
+            users = User.query.filter(User.user_id.in_(batch)).all()
+            users = dict((user.user_id, user) for user in users)
+
+            for user_id in batch:
+                user = users.get(user_id)
+                if user is None:
+                    user = User(user_id=user_id)
+                    db.session.add(user)
+                user.state_machine, user.last_online = states[user_id]
+
+    def flush(self):
+        '''
+            Write all pending states now
+            returns: number of users written
+        '''
+        with self.lock:
+            states, self.pending = self.pending, {}
+        if not states:
+            return 0
+
+        try:
+            # Requests flushing (backpressure) already have a context
+            if has_app_context():
+                self.write(states)
+            else:
+                with self.app.app_context():
+                    self.write(states)
+        except Exception:
+            log.exception('Could not write %d states, will retry', len(states))
+
+            # Keep them unless a newer state is pending already
+            with self.lock:
+                for user_id, state in states.items():
+                    self.pending.setdefault(user_id, state)
+            return 0
+
+        return len(states)
+
+    def stats(self):
+        '''
+            Counters of the user state cache
+        '''
+        stats = self.cache.stats()
+        stats.update({
+            'stale': self.stale,
+            'loads_avoided': self.loads_avoided,
+            'queries_avoided': self.queries_avoided,
+            'pending': len(self.pending),
+        })
+        return stats
+
+    def start_worker(self):
+        '''
+            A new lock and no flusher in this process: the ones of a preloading
+            master are of no use after forking, and under gevent they have to be
+            created once the worker is patched (see post_worker_init).
+        '''
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        '''
+            Start the flusher (lock not held). Done lazily on the first save so
+            it's started in every worker and not in a preloading master.
+        '''
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name='state-writer')
+            self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                if len(self.pending) < self.flush_size:
+                    self.wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def stop(self):
+        '''
+            Stop the flusher and write everything still pending
+        '''
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join(self.flush_interval + 1)
+            self.thread = None
+        self.flush()
+
+
+state_writer = StateWriter()
+
+
+def sqlite_pragma(name):
+    return db.session.execute(text('PRAGMA ' + name)).scalar()
+
+
+def database_size():
+    '''
+        returns: size of the SQLite database and of its free pages (bytes)
+    '''
+    page_size = sqlite_pragma('page_size')
+    return sqlite_pragma('page_count') * page_size, sqlite_pragma('freelist_count') * page_size
+
+
+def prune_users(cutoff, reset=False, batch_size=500, pause=0.05, vacuum_pages=1000):
+    '''
+        Delete the users not online since cutoff (with reset only their
+        state, they start over but stay in the stats). Every batch of
+        batch_size rows is its own transaction and we pause in between,
+        so other workers never wait long for the write lock.
+        Then the free pages are given back in steps of vacuum_pages (SQLite
+        with auto_vacuum = INCREMENTAL, see SQLITE_PRAGMAS and full_vacuum()).
+        returns: dict rows (deleted or reset), reclaimed and free (bytes, None if not SQLite)
+    '''
+    db.session.execute(LAST_ONLINE_INDEX)
+    db.session.commit()
+
+    sqlite = db.engine.url.drivername.startswith('sqlite')
+    if sqlite:
+        size_before, _ = database_size()
+
+    statement = RESET_IDLE if reset else DELETE_IDLE
+    rows = 0
+    while True:
+        try:
+            n = db.session.execute(statement, {'cutoff': cutoff, 'limit': batch_size}).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        rows += n
+        if n < batch_size:
+            break
+        time.sleep(pause)
+
+    report = {'rows': rows, 'reclaimed': None, 'free': None}
+    if not sqlite:
+        return report
+
+    # 2 is INCREMENTAL, otherwise free pages are only reused
+    if sqlite_pragma('auto_vacuum') == 2:
+        while sqlite_pragma('freelist_count'):
+            db.session.execute(text('PRAGMA incremental_vacuum({})'.format(int(vacuum_pages)))).fetchall()
+            db.session.commit()
+            time.sleep(pause)
+
+    size, free = database_size()
+    report['reclaimed'] = size_before - size
+    report['free'] = free
+    return report
+
+
+def full_vacuum():
+    '''
+        Rebuild the SQLite database with auto_vacuum = INCREMENTAL (needed
+        once for databases created without it). Locks the database meanwhile.
+        returns: bytes reclaimed
+    '''
+    size_before, _ = database_size()
+    db.session.commit()
+
+    # VACUUM can't run in a transaction
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        cursor.close()
+    finally:
+        connection.close()
+
+    size, _ = database_size()
+    return size_before - size
+
+
+class Pruner(object):
+    '''
+        Runs prune_users() every PRUNE_INTERVAL seconds in the background
+        (users idle for PRUNE_AFTER_DAYS). Started on the first request of
+        every worker, the workers which come after find nothing left to do.
+    '''
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 0
+        self.pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['PRUNE_INTERVAL']
+        self.days = app.config['PRUNE_AFTER_DAYS']
+        self.reset = app.config['PRUNE_RESET']
+        self.batch_size = app.config['PRUNE_BATCH_SIZE']
+
+        if self.interval:
+            app.before_request(self.start)
+
+    def start(self):
+        '''
+            Start the pruner in this process (before_request, not in a preloading master)
+        '''
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.run, name='user-pruner')
+        thread.daemon = True
+        thread.start()
+
+    def prune(self):
+        '''
+            returns: see prune_users()
+        '''
+        cutoff = datetime.now() - timedelta(days=self.days)
+        with self.app.app_context():
+            report = prune_users(cutoff, self.reset, self.batch_size)
+            db.session.remove()
+
+        metrics.inc('foodworld_pruned_users_total', report['rows'], mode='reset' if self.reset else 'delete')
+        if report['rows']:
+            log.info('Pruned %d users idle since %s, reclaimed %s bytes', report['rows'], cutoff, report['reclaimed'])
+        return report
+
+    def run(self):
+        # Don't start all workers at once
+        time.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                self.prune()
+            except Exception:
+                log.exception('Could not prune idle users')
+            time.sleep(self.interval)
+
+
+pruner = Pruner()
@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    '''
+        A bounded mapping which evicts the least recently used entries.
+        Entries optionally expire ttl seconds after they were put
+        (or after they were last used if idle is set).
+        Counts hits, misses, evictions and expirations to help sizing it.
+    '''
+    def __init__(self, maxsize, ttl=None, idle=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.idle = idle
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None:
+                now = time.time()
+                if expires < now:
+                    self.expirations += 1
+                    self.misses += 1
+                    return default
+                if self.idle:
+                    expires = now + self.ttl
+
+            # Most recently used entries are at the end
+            self.data[key] = value, expires
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value, expires
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,85 @@
+from array import array
+from math import ceil
+
+
+def trigrams(word):
+    '''
+        Character trigrams of a word, padded so short words
+        and the beginning of a word count as well ("  e", " eg", "egg", "gg ")
+        returns: set of trigrams
+    '''
+    padded = u'  ' + u' '.join(word.lower().split()) + u' '
+    return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+
+def similarity(a, b):
+    '''
+        Dice coefficient of two sets of trigrams (1.0 is the same word)
+    '''
+    if not a and not b:
+        return 1.0
+    return 2.0 * len(a & b) / (len(a) + len(b))
+
+
+class TrigramIndex(object):
+    '''
+        Finds the most similar word of a vocabulary, e.g. the ingredient
+        meant by a misrecognized slot value ("tomatoe" -> "tomato").
+        Trigram -> sorted word ids, like the ingredient index.
+    '''
+    def __init__(self, words):
+        self.words = sorted(words)
+        self.grams = [frozenset(trigrams(word)) for word in self.words]
+        self.sizes = array('i', (len(grams) for grams in self.grams))
+
+        postings = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('i')
+                posting.append(i)
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.words)
+
+    def nearest(self, word, threshold=0.6):
+        '''
+            The most similar word with a similarity of at least threshold
+            returns: (word, similarity) or (None, 0.0)
+        '''
+        grams = trigrams(word)
+        n = len(grams)
+        if not n:
+            return None, 0.0
+
+        # A word with m trigrams reaches the threshold only if it shares
+        # threshold * (n + m) / 2 of them, so m is between threshold * n / (2 - threshold)
+        # and n * (2 - threshold) / threshold. And it has one of the n - shared + 1
+        # rarest trigrams of the query, only those posting lists are read.
+        shortest = threshold * n / (2 - threshold)
+        longest = n * (2 - threshold) / threshold if threshold else float('inf')
+        shared = max(1, int(ceil(threshold * (n + shortest) / 2 - 1e-9)))
+        rarest = sorted(grams, key=lambda gram: len(self.postings.get(gram, ())))
+        candidates = set()
+        for gram in rarest[:n - shared + 1]:
+            candidates.update(self.postings.get(gram, ()))
+
+        all_grams, sizes = self.grams, self.sizes
+        shortest, longest = shortest - 1e-9, longest + 1e-9
+        best, best_score = None, 0.0
+        for i in candidates:
+            m = sizes[i]
+            if not shortest <= m <= longest:
+                continue
+            # similarity(), inlined
+            score = 2.0 * len(grams & all_grams[i]) / (n + m)
+            # Ties go to the shorter word (then alphabetical)
+            if score > best_score or (score == best_score and best is not None
+                                      and (len(self.words[i]), i) < (len(self.words[best]), best)):
+                best, best_score = i, score
+
+        if best is None or best_score < threshold:
+            return None, 0.0
+        return self.words[best], best_score
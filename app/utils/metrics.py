@@ -0,0 +1,121 @@
+from bisect import bisect_left
+
+from flask import g, has_request_context
+
+# Upper bounds of the histogram buckets
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BYTES = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, **extra):
+    labels = labels + tuple(sorted(extra.items()))
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+class Metrics(object):
+    '''
+        Histograms and counters of this process in the Prometheus text format.
+
+        Only one in METRICS_SAMPLE requests is measured (0 turns it off, then
+        nothing but a counter is touched per request): histograms are only
+        observed during the requests picked (see measuring()) and in the
+        background (e.g. write-behind flushes). One in METRICS_PROFILE
+        requests is run with cProfile (0 is off).
+    '''
+    def __init__(self):
+        self.sample = 0
+        self.profile = 0
+        self.requests = 0
+        self.histograms = {}
+        self.counters = {}
+
+    def init_app(self, app):
+        self.sample = app.config['METRICS_SAMPLE']
+        self.profile = app.config['METRICS_PROFILE']
+
+    @property
+    def enabled(self):
+        return self.sample > 0
+
+    def next_request(self):
+        '''
+            returns: whether to measure (and whether to profile) the next request
+        '''
+        self.requests += 1
+        measure = self.sample > 0 and self.requests % self.sample == 0
+        profile = self.profile > 0 and self.requests % self.profile == 0
+        return measure, profile
+
+    def measuring(self):
+        '''
+            returns: whether to observe now, within a request only if
+            it was picked by next_request() (g.metrics_start is set)
+        '''
+        if not self.sample:
+            return False
+        if has_request_context():
+            return getattr(g, 'metrics_start', None) is not None
+        return True
+
+    def observe(self, name, value, buckets=SECONDS, **labels):
+        if not self.measuring():
+            return
+        key = name, tuple(sorted(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self, gauges=None):
+        '''
+            All metrics in the Prometheus text format.
+            gauges: {name: value} of additional values (e.g. cache stats)
+        '''
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        for name, value in sorted((gauges or {}).items()):
+            declare(name, 'gauge')
+            lines.append('{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,145 @@
+import codecs
+import os
+import re
+
+from .cache import LRUCache
+
+# Ingredients users can say (the slot values of the skill)
+SLOT_VALUES = 'alexa/ingredients.txt'
+
+# Categories and countries users can say
+FACET_VALUES = ('alexa/categories.txt', 'alexa/countries.txt')
+
+# Prebuilt table: slot value -> normalized ingredient (python manage.py buildtable)
+TABLE = 'app/utils/ingredients.table'
+
+# Ignored ingredients
+IGNORED = ('water', 'salt', 'pepper')
+
+# The inflect engine (we use it to turn plurals into singulars)
+# Only created if a value is missing from the table, it's slow to import.
+inflect_engine = None
+
+
+def singular(ingredient):
+    '''
+        Singular of the last word using inflect
+        (attention if this is changed need to change in data cleaning)
+    '''
+    global inflect_engine
+    if inflect_engine is None:
+        import inflect
+        inflect_engine = inflect.engine()
+
+    s = ingredient.split(' ')
+    sing = inflect_engine.singular_noun(s[-1])
+    if sing:
+        if len(s) > 1:
+            return ' '.join(s[:-1] + [sing])
+        return sing
+    return ingredient
+
+
+def build_table(values, path=TABLE):
+    '''
+        Normalize all values (lowercase) with inflect and write them to the table
+    '''
+    lines = []
+    for value in sorted(set(v.strip().lower() for v in values)):
+        if value and value not in IGNORED:
+            lines.append(u'{}\t{}\n'.format(value, singular(value)))
+
+    tmp_path = path + '.tmp'
+    with codecs.open(tmp_path, 'w', 'utf-8') as f:
+        f.writelines(lines)
+    os.rename(tmp_path, path)
+    return len(lines)
+
+
+def load_table(path=TABLE):
+    '''
+        returns: dict slot value -> normalized ingredient (empty if not built)
+    '''
+    table = {}
+    if os.path.exists(path):
+        with codecs.open(path, 'r', 'utf-8') as f:
+            for line in f:
+                value, ingredient = line.rstrip(u'\n').split(u'\t')
+                table[value] = ingredient
+    return table
+
+# Never modified after loading
+table = load_table()
+
+# Values not in the table (normalized with inflect)
+memo = LRUCache(4096)
+
+
+def normalize_ingredient(ingredient):
+    '''
+        Turn an ingredient as said by the user into the form used in the recipes
+        returns: normalized ingredient or None if it is ignored
+    '''
+    ingredient = ingredient.lower()
+    if ingredient in IGNORED:
+        return None
+
+    normalized = table.get(ingredient)
+    if normalized is None:
+        normalized = memo.get(ingredient)
+        if normalized is None:
+            normalized = singular(ingredient)
+            memo.put(ingredient, normalized)
+
+    return normalized
+
+
+def normalize_facet(value):
+    '''
+        Turn a category or a country (said by the user or of a recipe)
+        into its indexed form, e.g. "Main Dishes" -> "main dish"
+    '''
+    value = value.strip().lower()
+    normalized = table.get(value)
+    if normalized is None:
+        normalized = memo.get(value)
+        if normalized is None:
+            normalized = singular(value)
+            memo.put(value, normalized)
+    return normalized
+
+
+def normalize_ingredients(ingredients):
+    '''
+        returns: set of normalized ingredients (without the ignored ones)
+    '''
+    normalized = set(normalize_ingredient(i) for i in ingredients)
+    normalized.discard(None)
+    return normalized
+
+
+def plural_pattern(ingredient):
+    '''
+        Regex finding a normalized (singular) ingredient or its plural as words
+    '''
+    if ingredient.endswith(u'y'):
+        word = re.escape(ingredient[:-1]) + u'(?:y|ies)'
+    else:
+        word = re.escape(ingredient) + u'(?:e?s)?'
+    return re.compile(u'(?<!\\w)' + word + u'(?!\\w)', re.IGNORECASE | re.UNICODE)
+
+
+def match_lines(lines, ingredients):
+    '''
+        Find the verbose ingredient line (e.g. "2 large eggs") of every
+        normalized ingredient of a recipe (e.g. "egg")
+        returns: dict normalized ingredient -> index of its first line
+    '''
+    found = {}
+    for ingredient in ingredients:
+        pattern = plural_pattern(ingredient)
+        for i, line in enumerate(lines):
+            if pattern.search(line):
+                found[ingredient] = i
+                break
+    return found
@@ -0,0 +1,288 @@
+import _socket
+import cPickle as pickle
+import logging
+import os
+import signal
+import socket
+import struct
+import time
+from Queue import Queue, Empty
+
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Messages between the worker and its search processes: length + pickle
+HEADER = struct.Struct('!I')
+
+
+class SearchOverloaded(Exception):
+    '''
+        The search could not be done in time (queue full or timeout)
+    '''
+
+
+def send_message(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 65536))
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+
+def receive_message(sock):
+    n, = HEADER.unpack(receive_exactly(sock, HEADER.size))
+    return pickle.loads(receive_exactly(sock, n))
+
+
+def gevent_hub():
+    '''
+        returns: the gevent hub if we're running in a gevent worker, else None
+    '''
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('socket'):
+        return None
+    return get_hub()
+
+
+def serve(sock):
+    '''
+        Main loop of a search process: run functions until the worker goes away
+    '''
+    while True:
+        try:
+            func, args = receive_message(sock)
+        except EOFError:
+            return
+
+        started = time.time()
+        result = func(*args)
+        send_message(sock, (result, started, time.time()))
+
+
+def idle_queue():
+    '''
+        returns: a queue which waits without blocking the event loop (in a gevent worker)
+    '''
+    if gevent_hub() is not None:
+        from gevent.queue import Queue as CooperativeQueue
+        return CooperativeQueue()
+    return Queue()
+
+
+class SearchProcess(object):
+    '''
+        A child process forked from the worker, so the recipes and indices
+        are already loaded (shared copy-on-write).
+    '''
+    def __init__(self):
+        # A plain blocking socket pair, not the one patched by gevent
+        parent, child = _socket.socketpair()
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            parent.close()
+            try:
+                serve(child)
+            finally:
+                os._exit(0)
+
+        child.close()
+        # Wrapped to cooperate with the event loop (in a gevent worker)
+        if gevent_hub() is not None:
+            from gevent.socket import socket as cooperative_socket
+            self.sock = cooperative_socket(_sock=parent)
+        else:
+            self.sock = socket.socket(_sock=parent)
+
+    def kill(self):
+        '''
+            Stop the process (once: afterwards its pid may belong to another process)
+        '''
+        self.sock.close()
+        if self.pid is None:
+            return
+        pid, self.pid = self.pid, None
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+class SearchPool(object):
+    '''
+        Runs CPU heavy searches outside the event loop of the gevent worker
+        so quick requests of other users don't have to wait.
+
+        SEARCH_OFFLOAD = 'process': a warm pool of SEARCH_PROCESSES forked children
+        SEARCH_OFFLOAD = 'thread': the gevent threadpool (still shares the GIL)
+        SEARCH_OFFLOAD = None: run in the request
+
+        A search waits at most SEARCH_TIMEOUT seconds (queueing and computing),
+        with SEARCH_MAX_QUEUE searches waiting it fails right away.
+    '''
+    def __init__(self):
+        self.mode = None
+        self.pid = None
+        self.children = []
+        self.idle = None
+        self.waiting = 0
+
+        # Metrics (seconds)
+        self.searches = 0
+        self.overloaded = 0
+        self.queue_wait = 0.0
+        self.compute = 0.0
+
+    def init_app(self, app):
+        self.mode = app.config['SEARCH_OFFLOAD']
+        self.processes = app.config['SEARCH_PROCESSES']
+        self.timeout = app.config['SEARCH_TIMEOUT']
+        self.max_queue = app.config['SEARCH_MAX_QUEUE']
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def start(self):
+        '''
+            Fork the search processes of this worker
+            (lazily on the first search, or after forking the worker).
+        '''
+        if self.mode != 'process' or self.pid == os.getpid():
+            return
+
+        # Processes inherited from the master belong to somebody else
+        self.pid = os.getpid()
+        self.children = [SearchProcess() for i in range(self.processes)]
+        self.idle = idle_queue()
+        for child in self.children:
+            self.idle.put(child)
+
+    def restart(self):
+        '''
+            Replace the search processes (e.g. after the corpus was reloaded),
+            busy ones are stopped once they're done.
+        '''
+        if self.mode != 'process' or self.pid != os.getpid():
+            return
+
+        idle = self.idle
+        self.pid = None
+        self.children = []
+        self.start()
+
+        while True:
+            try:
+                idle.get_nowait().kill()
+            except Empty:
+                break
+
+    def run(self, func, *args):
+        '''
+            Run func(*args) (picklable) in the pool
+            returns: its result
+        '''
+        if self.waiting >= self.max_queue:
+            self.overloaded += 1
+            raise SearchOverloaded('{} searches waiting'.format(self.waiting))
+
+        self.waiting += 1
+        try:
+            if self.mode == 'process':
+                return self.run_process(func, args)
+            return self.run_thread(func, args)
+        finally:
+            self.waiting -= 1
+
+    def record(self, queue_wait, compute):
+        self.searches += 1
+        self.queue_wait += queue_wait
+        self.compute += compute
+        metrics.observe('foodworld_search_queue_seconds', queue_wait)
+        metrics.observe('foodworld_search_compute_seconds', compute)
+        log.debug('Search waited %.1f ms, computed %.1f ms', 1000 * queue_wait, 1000 * compute)
+
+    def run_process(self, func, args):
+        self.start()
+        submitted = time.time()
+        try:
+            child = self.idle.get(timeout=self.timeout)
+        except Empty:
+            self.overloaded += 1
+            raise SearchOverloaded('No search process available')
+
+        try:
+            child.sock.settimeout(max(0.01, self.timeout - (time.time() - submitted)))
+            send_message(child.sock, (func, args))
+            result, started, finished = receive_message(child.sock)
+            child.sock.settimeout(None)
+        except (socket.timeout, socket.error, EOFError):
+            # Still busy (or dead), replace it by a fresh one
+            child.kill()
+            if child in self.children:
+                self.children.remove(child)
+                child = SearchProcess()
+                self.children.append(child)
+            self.overloaded += 1
+            raise SearchOverloaded('Search timed out')
+        finally:
+            # Not one of ours anymore after a restart (kill() does nothing if it's dead already)
+            if child in self.children:
+                self.idle.put(child)
+            else:
+                child.kill()
+
+        self.record(started - submitted, finished - started)
+        return result
+
+    def run_thread(self, func, args):
+        hub = gevent_hub()
+        if hub is None:
+            started = time.time()
+            result = func(*args)
+            self.record(0.0, time.time() - started)
+            return result
+
+        from gevent import Timeout
+
+        submitted = time.time()
+        timing = {}
+
+        def timed():
+            timing['started'] = time.time()
+            return func(*args)
+
+        try:
+            result = hub.threadpool.spawn(timed).get(timeout=self.timeout)
+        except Timeout:
+            self.overloaded += 1
+            raise SearchOverloaded('Search timed out')
+
+        started = timing['started']
+        self.record(started - submitted, time.time() - started)
+        return result
+
+    def stats(self):
+        return {
+            'searches': self.searches,
+            'overloaded': self.overloaded,
+            'waiting': self.waiting,
+            'queue_wait': self.queue_wait,
+            'compute': self.compute,
+        }
+
+
+search_pool = SearchPool()
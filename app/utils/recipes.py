@@ -1,13 +1,32 @@
+import codecs
+import hashlib
+import logging
+import os
 import pickle
 import random
+import threading
+import time
+from array import array
+from fractions import gcd
 
-import inflect
+from flask import g, has_app_context
 
-# The inflect engine (we use it to tunr plurals into singulars)
-inflect_engine = inflect.engine()
+from .cache import LRUCache
+from .fuzzy import TrigramIndex
+from .metrics import metrics
+from .normalize import normalize_ingredient, normalize_ingredients, normalize_facet, table, SLOT_VALUES
+from .offload import search_pool, SearchOverloaded, gevent_hub
+from .search import ScanEngine, InvertedIndex, BitsetIndex, scan, intersect
+from .store import MappedCorpus, ListCorpus, RecipeStore, _utf8
+
+log = logging.getLogger(__name__)
+
+# Can be overridden, e.g. to run benchmarks on a synthetic corpus
+RECIPES_PICKLE = os.environ.get('RECIPES_PICKLE') or 'app/utils/recipes.pickle'
+RECIPES_STORE = os.environ.get('RECIPES_STORE') or 'app/utils/recipes.store'
 
 # Load all 25k recipes; format:
-# all_recipes = [
+# recipes = [
 #   [
 #       'title',
 #       [
@@ -21,44 +40,596 @@ inflect_engine = inflect.engine()
 #   ],
 #   ...
 # ]
-all_recipes = pickle.load(open('app/utils/recipes.pickle', 'r'))
+#
+# If the memory-mapped store exists (python manage.py buildstore) it is used
+# instead: recipes are only decoded when accessed and workers share the pages.
+def load_corpus():
+    if os.path.exists(RECIPES_STORE):
+        try:
+            return MappedCorpus(RECIPES_STORE)
+        except ValueError:
+            # E.g. a store of an older version, until it's rebuilt
+            log.warning('Loading the pickle instead of the store', exc_info=True)
+    return ListCorpus(pickle.load(open(RECIPES_PICKLE, 'r')))
+
+
+def corpus_path():
+    '''
+        The file load_corpus() reads (to notice when it was rebuilt)
+    '''
+    return RECIPES_STORE if os.path.exists(RECIPES_STORE) else RECIPES_PICKLE
+
+
+# Stable recipe ids are >= STABLE_IDS, smaller numbers are recipe indices
+# stored by older sessions (indices into the first corpus loaded)
+STABLE_IDS = 1 << 48
+
+
+def stable_ids(corpus):
+    '''
+        Ids which survive rebuilding the corpus (recipes added, removed,
+        fixed or reordered): a hash of title and author. Recipes with the
+        same title and author get the next free id in corpus order.
+        returns: list of ids by recipe index
+    '''
+    ids = []
+    used = set()
+    for title, author in corpus.identities():
+        i = STABLE_IDS | int(hashlib.sha1(_utf8(title) + '\0' + _utf8(author)).hexdigest()[:12], 16)
+        while i in used:
+            i += 1
+        used.add(i)
+        ids.append(i)
+    return ids
+
+
+def facet_terms(categories=(), country=None):
+    '''
+        Categories and countries are searched like ingredients using
+        terms such as u'category:dessert' and u'country:thai'
+        returns: set of terms
+    '''
+    terms = set(u'category:' + normalize_facet(c) for c in categories if c)
+    if country:
+        terms.add(u'country:' + normalize_facet(country))
+    return terms
+
+
+def is_facet(term):
+    return term.startswith((u'category:', u'country:'))
+
+
+# Engines which can be selected using the config (SEARCH_ENGINE)
+engines = {
+    'scan': ScanEngine,
+    'index': InvertedIndex,
+    'bitset': BitsetIndex,
+}
+
+# Search settings, see init_app()
+engine_name = 'index'
+search_cache_size = 1024
+search_cache_ttl = 3600
 
+# Partial matches if no recipe has all ingredients (see InvertedIndex.top_k)
+ranked_k = 20
+ranked_weighting = 'idf'
 
-def find_recipes(ingredients):
+# Misrecognized ingredients, see resolve_ingredient()
+fuzzy_threshold = 0.6
+
+# Reloading the corpus, see reload_corpus()
+keep_generations = 2
+reload_interval = 0
+
+
+class Generation(object):
+    '''
+        One version of the corpus and everything derived from it: the
+        recipes, their stable ids, the indices and the search results.
+        Reloading builds a new generation instead of changing this one,
+        search results are recipe indices of their generation.
+    '''
+    def __init__(self, number, corpus):
+        self.number = number
+        self.corpus = corpus
+
+        # Use this to access recipes by field: store[i].title
+        self.store = RecipeStore(corpus)
+        self.ids = stable_ids(corpus)
+        self.positions = dict((id, i) for i, id in enumerate(self.ids))
+
+        # Posting lists (ingredient -> sorted recipe indices) so we don't scan all recipes
+        self.ingredient_index = InvertedIndex(corpus.ingredient_sets())
+
+        # Posting lists of the categories and countries (see facet_terms())
+        self.facet_index = InvertedIndex(facet_terms(categories, country) for categories, country in corpus.facets())
+
+        self.engine = self.ingredient_index
+        self.use_engine(engine_name)
+
+        # Trigrams of all ingredients and the ingredients said before (see resolve_ingredient())
+        self.vocabulary = TrigramIndex(self.ingredient_index.postings)
+        self.resolved = LRUCache(4096)
+
+        # Sorted results by normalized query (frozenset of terms),
+        # ranked results by (query, k)
+        self.cache = LRUCache(search_cache_size, ttl=search_cache_ttl)
+
+        # Requests using this generation, see pin_generation()
+        self.readers = 0
+        self.retired = False
+        self.mtime = None
+
+    def use_engine(self, name):
+        '''
+            Select the search engine used by find_recipes().
+            Engines other than the default index are only built when selected.
+        '''
+        if name == 'index':
+            self.engine = self.ingredient_index
+        elif not isinstance(self.engine, engines[name]):
+            self.engine = engines[name](self.corpus.ingredient_sets())
+
+    def warm_resolved(self):
+        '''
+            Resolve all slot values (see alexa/ingredients.txt) upfront
+            which don't match an ingredient of the corpus once normalized.
+            Only uses the prebuilt table, values missing from it would need inflect.
+        '''
+        self.resolved.clear()
+        if not fuzzy_threshold or not os.path.exists(SLOT_VALUES):
+            return
+        with codecs.open(SLOT_VALUES, 'r', 'utf-8') as f:
+            for value in f:
+                normalized = table.get(value.strip().lower())
+                if normalized and normalized not in self.ingredient_index.postings:
+                    self.resolved.put(normalized, self.vocabulary.nearest(normalized, fuzzy_threshold)[0])
+
+    def close(self):
+        '''
+            Release the mapped store (once no request uses this generation)
+        '''
+        if isinstance(self.corpus, MappedCorpus):
+            self.corpus.close()
+
+
+def load_generation(number):
+    mtime = os.path.getmtime(corpus_path())
+    generation = Generation(number, load_corpus())
+    generation.mtime = mtime
+    return generation
+
+# Newest first: the current generation and the older ones still kept
+# so sessions can resolve recipes which were removed since
+generations = [load_generation(0)]
+generations_lock = threading.Lock()
+
+# Stable ids of the recipe indices stored by older sessions
+legacy_ids = generations[0].ids
+
+def generation():
+    '''
+        The generation used by the current request (pinned on flask.g,
+        see pin_generation()), the newest otherwise
+    '''
+    pinned = getattr(g, 'corpus_generation', None) if has_app_context() else None
+    return pinned if pinned is not None else generations[0]
+
+
+def generation_by_number(number):
+    for candidate in list(generations):
+        if candidate.number == number:
+            return candidate
+    return None
+
+
+def pin_generation():
+    '''
+        Use the newest generation during the whole request (before_request)
+        so a reload in the middle can't mix up recipe indices.
+    '''
+    if reload_interval and watcher_pid != os.getpid():
+        start_watcher()
+
+    with generations_lock:
+        current = generations[0]
+        current.readers += 1
+    g.corpus_generation = current
+
+
+def release_generation(exception=None):
+    '''
+        End of the request (teardown_request), closes a retired generation
+        when its last request is done
+    '''
+    current = getattr(g, 'corpus_generation', None)
+    if current is None:
+        return
+    g.corpus_generation = None
+
+    with generations_lock:
+        current.readers -= 1
+        drained = current.retired and current.readers == 0
+    if drained:
+        current.close()
+
+
+def swap(new):
+    '''
+        Make a new generation the current one. Running requests keep theirs,
+        generations beyond CORPUS_GENERATIONS are closed once drained.
+    '''
+    with generations_lock:
+        generations.insert(0, new)
+        retired = generations[keep_generations:]
+        del generations[keep_generations:]
+        for old in retired:
+            old.retired = True
+        drained = [old for old in retired if old.readers == 0]
+
+    for old in drained:
+        old.close()
+
+    # The search processes were forked with the previous generation
+    search_pool.restart()
+
+
+def build_generation(number):
+    new = load_generation(number)
+    new.use_engine(engine_name)
+    new.warm_resolved()
+    return new
+
+
+def reload_corpus():
+    '''
+        Load the corpus again and build a new generation next to the current
+        one (this takes a while), then swap it in.
+        In a gevent worker the watcher is a greenlet, the building runs in
+        a real thread of the hub so requests go on meanwhile (only the swap
+        runs in the event loop).
+        returns: the new generation
+    '''
+    started = time.time()
+    number = generations[0].number + 1
+    hub = gevent_hub()
+    if hub is not None:
+        new = hub.threadpool.apply(build_generation, (number,))
+    else:
+        new = build_generation(number)
+    swap(new)
+    log.info('Loaded generation %d of the corpus (%d recipes) in %.1f s',
+             new.number, len(new.corpus), time.time() - started)
+    return new
+
+
+# Process which watches the corpus file (started lazily in every worker)
+watcher_pid = None
+
+
+def start_watcher():
+    global watcher_pid
+    watcher_pid = os.getpid()
+    thread = threading.Thread(target=watch_corpus, name='corpus-watcher')
+    thread.daemon = True
+    thread.start()
+
+
+def watch_corpus():
+    '''
+        Reload the corpus when its file changed (e.g. python manage.py buildstore),
+        checked every CORPUS_RELOAD_INTERVAL seconds
+    '''
+    while True:
+        time.sleep(reload_interval)
+        try:
+            if os.path.getmtime(corpus_path()) != generations[0].mtime:
+                reload_corpus()
+        except Exception:
+            log.exception('Could not reload the corpus')
+
+
+class StableRecipes(object):
+    '''
+        Recipes by stable id (see stable_ids()): from the generation of the
+        request or, if it was removed since, from an older generation still kept.
+    '''
+    def __getitem__(self, id):
+        for candidate in [generation()] + generations:
+            i = candidate.positions.get(id)
+            if i is not None:
+                return candidate.store[i]
+        raise IndexError('unknown recipe {}'.format(id))
+
+    def __contains__(self, id):
+        return any(id in candidate.positions for candidate in [generation()] + generations)
+
+    def __len__(self):
+        return len(generation().corpus)
+
+# Use this to access recipes by field: recipe_store[id].title
+recipe_store = StableRecipes()
+
+
+def legacy_recipe(recipe):
+    '''
+        Convert a recipe index stored by an older session into a stable id
+        returns: stable id (-1 stays -1)
+    '''
+    if 0 <= recipe < STABLE_IDS:
+        return legacy_ids[recipe] if recipe < len(legacy_ids) else -1
+    return recipe
+
+
+def init_app(app):
+    '''
+        Apply the search settings of the app config
+    '''
+    global search_cache_size, search_cache_ttl, ranked_k, ranked_weighting, keep_generations, reload_interval
+    global fuzzy_threshold
+    search_cache_size = app.config['SEARCH_CACHE_SIZE']
+    search_cache_ttl = app.config['SEARCH_CACHE_TTL']
+    ranked_k = app.config['SEARCH_RANKED_K']
+    ranked_weighting = app.config['SEARCH_RANKED_WEIGHTING']
+    keep_generations = max(1, app.config['CORPUS_GENERATIONS'])
+    reload_interval = app.config['CORPUS_RELOAD_INTERVAL']
+    fuzzy_threshold = app.config['INGREDIENT_MATCH_THRESHOLD']
+
+    use_engine(app.config['SEARCH_ENGINE'])
+    for candidate in generations:
+        candidate.cache.maxsize = search_cache_size
+        candidate.cache.ttl = search_cache_ttl
+        candidate.cache.clear()
+        candidate.warm_resolved()
+    search_pool.init_app(app)
+
+    app.before_request(pin_generation)
+    app.teardown_request(release_generation)
+
+
+def use_engine(name):
+    '''
+        Select the search engine used by find_recipes() (in all generations)
+    '''
+    global engine_name
+    engine_name = name
+    for candidate in generations:
+        candidate.use_engine(name)
+
+
+def resolve_ingredient(ingredient):
+    '''
+        The ingredient meant by an ingredient as said by the user: if it
+        isn't an ingredient of the corpus once normalized, the most similar
+        one (see TrigramIndex) if it is similar enough (INGREDIENT_MATCH_THRESHOLD).
+        returns: the ingredient as said (known, ignored or nothing similar
+        enough) or the normalized ingredient replacing it
+    '''
+    normalized = normalize_ingredient(ingredient)
+    current = generation()
+    if normalized is None or normalized in current.ingredient_index.postings or not fuzzy_threshold:
+        return ingredient
+
+    if normalized in current.resolved:
+        nearest = current.resolved.get(normalized)
+    else:
+        nearest = current.vocabulary.nearest(normalized, fuzzy_threshold)[0]
+        current.resolved.put(normalized, nearest)
+        metrics.inc('foodworld_fuzzy_ingredients_total', matched='yes' if nearest else 'no')
+    return nearest or ingredient
+
+
+def permutation(n, seed):
+    '''
+        Cheap seeded permutation of n elements: position i -> (a * i + b) % n
+        with a coprime to n (so every element shows up exactly once).
+        returns: a, b
+    '''
+    if n < 2:
+        return 1, 0
+
+    rand = random.Random(seed)
+    a = rand.randrange(1, n)
+    while gcd(a, n) != 1:
+        a = rand.randrange(1, n)
+    return a, rand.randrange(n)
+
+
+def shuffled(recipes, seed):
+    n = len(recipes)
+    a, b = permutation(n, seed)
+    return [recipes[(a * i + b) % n] for i in xrange(n)]
+
+
+def search(generation, query, k=None, weighting=None):
+    '''
+        Search without cache.
+        Categories and countries narrow down the candidates first.
+    '''
+    facets = frozenset(term for term in query if is_facet(term))
+    ingredients = query - facets
+    within = generation.facet_index.lookup(facets) if facets else None
+
+    if k:
+        return array('i', generation.ingredient_index.top_k(ingredients, k, weighting, within))
+    if within is not None:
+        return array('i', generation.ingredient_index.lookup(ingredients, within))
+    return array('i', generation.engine.lookup(query))
+
+
+def engine_lookup(number, query, k=None, weighting=None):
+    '''
+        search() in the search pool
+        returns: the results or None if the process doesn't have the generation
+    '''
+    generation = generation_by_number(number)
+    if generation is None:
+        return None
+    return search(generation, query, k, weighting)
+
+
+def refine(generation, query, previous=None):
+    '''
+        Derive the results of a query from the cached results of a smaller
+        query: the previous search of the user (before adding ingredients)
+        or the query without one of its terms (e.g. searched before the
+        last ingredient was added, or before one was removed again).
+        Only the posting lists of the missing terms are intersected.
+        returns: sorted array of recipe indices, None if nothing is cached
+    '''
+    subsets = [query - frozenset([i]) for i in query] if len(query) > 1 else []
+    if previous is not None and previous < query:
+        subsets.insert(0, previous)
+
+    best = None
+    for subset in subsets:
+        if subset in generation.cache:
+            recipes = generation.cache.get(subset)
+            if recipes is not None and (best is None or len(recipes) < len(best[1])):
+                best = subset, recipes
+    if best is None:
+        return None
+
+    subset, recipes = best
+    for term in query - subset:
+        index = generation.facet_index if is_facet(term) else generation.ingredient_index
+        posting = index.postings.get(term)
+        if posting is None:
+            return array('i')
+        recipes = intersect(recipes, posting)
+    return array('i', recipes)
+
+
+def lookup(query, offload=False, k=None, previous=None):
+    '''
+        All recipes matching a normalized query (frozenset), cached.
+        With k only the k best partial matches (see rank_recipes()).
+        previous: the last query of the user, see refine()
+        With offload the search runs in the search pool if one is configured
+        and may raise SearchOverloaded.
+        returns: sorted array of recipe indices of the generation of
+        the request (best first if ranked)
+    '''
+    current = generation()
+    key = (query, k) if k else query
+    recipes = current.cache.get(key)
+    if recipes is None:
+        started = time.time()
+        kind = 'ranked' if k else 'refined'
+        if not k:
+            recipes = refine(current, query, previous)
+        if recipes is None:
+            kind = 'full'
+            if offload and search_pool.enabled:
+                recipes = search_pool.run(engine_lookup, current.number, query, k, ranked_weighting)
+            # Not offloaded, or the corpus was reloaded in the meantime
+            if recipes is None:
+                recipes = search(current, query, k, ranked_weighting)
+        metrics.observe('foodworld_search_seconds', time.time() - started, kind=kind)
+        current.cache.put(key, recipes)
+    return recipes
+
+
+def find_recipes(ingredients, seed=None, category=None, country=None):
     '''
         Find all recipes which contain all ingredients
-        returns: list of recipe indices
-    '''
-    # We want singulars (attention if this is changed need to change in data cleaning)
-    ing = []
-    for ingredient in ingredients:
-        ingredient = ingredient.lower()
-
-        # Ignored ingredients
-        if ingredient in ('water', 'salt', 'pepper'):
-            continue
-
-        s = ingredient.split(' ')
-        sing = inflect_engine.singular_noun(s[-1])
-        if sing:
-            if len(s) > 1:
-                ing.append(' '.join(s[:-1] + [sing]))
-            else:
-                ing.append(sing)
-        else:
-            ing.append(ingredient)
-
-    # Find recipes
-    ingredients = set(ing)
-    recipes = []
-    for i, recipe in enumerate(all_recipes):
-        if recipe[1][1].issuperset(ingredients):
-            recipes.append(i)
+        (optionally only of a category and/or a country)
+        returns: list of stable recipe ids
+    '''
+    facets = facet_terms([category], country)
+    ids = generation().ids
+    recipes = lookup(frozenset(normalize_ingredients(ingredients) | facets))
 
     # Shuffle to give more random results
-    random.shuffle(recipes)
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    return [ids[i] for i in shuffled(recipes, seed)]
 
-    return recipes
+
+def rank_recipes(ingredients, k=None):
+    '''
+        Find the k recipes sharing the most ingredients (all of them first),
+        weighted by SEARCH_RANKED_WEIGHTING
+        returns: list of stable recipe ids, best first
+    '''
+    ids = generation().ids
+    return [ids[i] for i in lookup(frozenset(normalize_ingredients(ingredients)), k=k or ranked_k)]
+
+
+def new_cursor(ingredients, ranked=False, facets=()):
+    '''
+        A search cursor is what we keep in the session instead of the results:
+        the normalized query, the seed of the shuffle and the current position.
+        Ranked cursors walk through the best partial matches (not shuffled),
+        'ranked' is their number (if ranking is on).
+        facets: only recipes with these categories and country (see facet_terms())
+    '''
+    cursor = {
+        'query': sorted(normalize_ingredients(ingredients) | set(facets)),
+        'seed': random.getrandbits(32),
+        'position': 0,
+    }
+    if ranked and ranked_k:
+        cursor['ranked'] = ranked_k
+    return cursor
+
+
+def cursor_lookup(cursor, offload=False, previous=None):
+    if previous is not None:
+        previous = frozenset(previous['query'])
+    return lookup(frozenset(cursor['query']), offload, cursor.get('ranked'), previous)
+
+
+def cursor_size(cursor, offload=False, previous=None):
+    '''
+        previous: the last cursor of the user, a new search only
+        has to narrow it down if ingredients were added since.
+    '''
+    return len(cursor_lookup(cursor, offload, previous))
+
+
+def cursor_recipe(cursor):
+    '''
+        The recipe at the current position of a search cursor, in constant time
+        (after a reload the position continues in the new results)
+        returns: stable recipe id
+    '''
+    ids = generation().ids
+    recipes = cursor_lookup(cursor)
+    n = len(recipes)
+    if cursor.get('ranked'):
+        return ids[recipes[cursor['position'] % n]]
+
+    a, b = permutation(n, cursor['seed'])
+    return ids[recipes[(a * cursor['position'] + b) % n]]
+
+
+def cursor_recipes(cursor):
+    '''
+        Rehydrate all (shuffled) results of a search cursor
+        returns: list of stable recipe ids
+    '''
+    ids = generation().ids
+    if cursor.get('ranked'):
+        return [ids[i] for i in cursor_lookup(cursor)]
+    return [ids[i] for i in shuffled(cursor_lookup(cursor), cursor['seed'])]
+
+
+def find_recipes_batch(ingredient_lists):
+    '''
+        Find the recipes for many ingredient lists in one call.
+        Also warms the search cache (e.g. with popular searches).
+        returns: list of stable recipe id lists (in corpus order, not shuffled)
+    '''
+    current = generation()
+    queries = [frozenset(normalize_ingredients(i)) for i in ingredient_lists]
+    missing = [q for q in set(queries) if q not in current.cache]
+    for query, recipes in zip(missing, current.engine.lookup_many(missing)):
+        current.cache.put(query, array('i', recipes))
+
+    return [[current.ids[i] for i in lookup(query)] for query in queries]
 
 
 def show_recipe(recipe):
@@ -81,6 +652,7 @@ def show_recipe(recipe):
 
 
 if __name__ == '__main__':
+    # Run from the repository root: python -m app.utils.recipes
     import time
 
     ingredients = ['chicken', 'eggplant']
@@ -93,4 +665,33 @@ if __name__ == '__main__':
     duration = round((time.time() - before )/n, 1)
     print 'Found {} recipes, {} s per request'.format(len(recipes), duration)
 
-    show_recipe(all_recipes[recipes[0]])
\ No newline at end of file
+    # Compare the engines against scanning all recipes
+    current = generation()
+    ingredient_sets = list(current.corpus.ingredient_sets())
+    names = sorted(engines)
+    built = dict((name, engines[name](ingredient_sets)) for name in names)
+    for query in (['chicken'], ['chicken', 'eggplant'], ['eggs', 'flour', 'sugar'], ['salt']):
+        normalized = normalize_ingredients(query)
+        expected = scan(ingredient_sets, normalized)
+
+        timings = []
+        for name in names:
+            assert list(built[name].lookup(normalized)) == expected, name
+
+            before = time.time()
+            for i in range(n):
+                built[name].lookup(normalized)
+            timings.append('{} {:.3f} ms'.format(name, 1000 * (time.time() - before) / n))
+
+        print '{}: {} per request'.format(', '.join(query), ', '.join(timings))
+
+    # Ranked partial matches (the first query has no recipe using everything)
+    for query in (['chicken', 'eggplant', 'marshmallows', 'kale'], ['salt', 'pepper']):
+        normalized = normalize_ingredients(query)
+        before = time.time()
+        for i in range(n):
+            current.ingredient_index.top_k(normalized, ranked_k, ranked_weighting)
+        print 'top {} for {}: {:.3f} ms per request'.format(
+            ranked_k, ', '.join(query), 1000 * (time.time() - before) / n)
+
+    show_recipe(current.corpus[current.positions[recipes[0]]])
\ No newline at end of file
@@ -0,0 +1,205 @@
+import heapq
+from array import array
+from binascii import hexlify
+from bisect import bisect_left
+from math import log
+
+
+def scan(ingredient_sets, ingredients):
+    '''
+        Reference search: check every single recipe.
+        returns: sorted list of recipe indices
+    '''
+    return [i for i, s in enumerate(ingredient_sets) if s.issuperset(ingredients)]
+
+
+def bits_to_ids(bits):
+    '''
+        Decode a big-int bitset into the sorted indices of its set bits
+    '''
+    ids = []
+    # Reversed binary string: character i is bit i
+    digits = bin(bits)[:1:-1]
+    i = digits.find('1')
+    while i != -1:
+        ids.append(i)
+        i = digits.find('1', i + 1)
+    return ids
+
+
+def intersect(candidates, posting):
+    '''
+        Intersect a short sorted list with a (usually longer) sorted posting list.
+        Binary search lets us skip ahead in the posting list.
+    '''
+    found = []
+    lo, hi = 0, len(posting)
+    for i in candidates:
+        lo = bisect_left(posting, i, lo, hi)
+        if lo == hi:
+            break
+        if posting[lo] == i:
+            found.append(i)
+    return found
+
+
+class Engine(object):
+    '''
+        Common interface of all search engines.
+    '''
+    def lookup(self, ingredients):
+        raise NotImplementedError
+
+    def lookup_many(self, queries):
+        '''
+            Look up a batch of ingredient sets (e.g. to warm popular searches)
+            returns: list of results in the order of the queries
+        '''
+        return [self.lookup(ingredients) for ingredients in queries]
+
+
+class ScanEngine(Engine):
+    '''
+        Wraps scan() so it can be selected like the indices (mainly for benchmarks).
+    '''
+    def __init__(self, ingredient_sets):
+        self.ingredient_sets = list(ingredient_sets)
+
+    def lookup(self, ingredients):
+        return scan(self.ingredient_sets, ingredients)
+
+
+class InvertedIndex(Engine):
+    '''
+        Maps every ingredient to the sorted indices of the recipes using it.
+        Posting lists are compact int arrays, built once when the corpus loads.
+    '''
+    def __init__(self, ingredient_sets):
+        postings = {}
+        size = 0
+        for i, ingredients in enumerate(ingredient_sets):
+            for ingredient in ingredients:
+                posting = postings.get(ingredient)
+                if posting is None:
+                    posting = postings[ingredient] = array('i')
+                posting.append(i)
+            size += 1
+
+        self.postings = postings
+        self.size = size
+
+    def lookup(self, ingredients, within=None):
+        '''
+            Find all recipes which contain all ingredients
+            within: only these recipes (sorted, e.g. the recipes of a category)
+            returns: sorted list of recipe indices (same as scan())
+        '''
+        # Every recipe is a superset of nothing
+        if not ingredients:
+            return range(self.size) if within is None else list(within)
+
+        postings = [] if within is None else [within]
+        for ingredient in ingredients:
+            posting = self.postings.get(ingredient)
+            if posting is None:
+                return []
+            postings.append(posting)
+
+        # Start with the rarest ingredient, the candidate list only shrinks
+        postings.sort(key=len)
+        recipes = list(postings[0])
+        for posting in postings[1:]:
+            if not recipes:
+                break
+            recipes = intersect(recipes, posting)
+
+        return recipes
+
+    def weight(self, ingredient, weighting='count'):
+        '''
+            How much sharing an ingredient counts when ranking:
+            'count' every ingredient the same, 'idf' rare ingredients more
+        '''
+        if weighting == 'idf':
+            return log(float(self.size) / len(self.postings[ingredient]))
+        return 1
+
+    def top_k(self, ingredients, k, weighting='count', within=None):
+        '''
+            The k recipes sharing the most ingredients with the query,
+            so there are results even if no recipe has all ingredients.
+            within: only these recipes (sorted)
+
+            Stops right away if k recipes have all ingredients. Otherwise the
+            scores are summed up rarest ingredient first, as soon as recipes
+            not seen yet can't beat the k best anymore the longer posting
+            lists are only intersected with the candidates (no full pass).
+            returns: list of recipe indices, best first (all ingredients first)
+        '''
+        recipes = self.lookup(ingredients, within)
+        if len(recipes) >= k:
+            return recipes[:k]
+
+        terms = [(self.weight(i, weighting), self.postings[i]) for i in ingredients if i in self.postings]
+        if within is not None:
+            terms = [(weight, intersect(within, posting)) for weight, posting in terms]
+        terms.sort(key=lambda term: len(term[1]))
+
+        scores = {}
+        remaining = sum(weight for weight, posting in terms)
+        for weight, posting in terms:
+            if len(scores) >= k and heapq.nlargest(k, scores.itervalues())[-1] >= remaining:
+                for i in intersect(sorted(scores), posting):
+                    scores[i] += weight
+            else:
+                for i in posting:
+                    scores[i] = scores.get(i, 0) + weight
+            remaining -= weight
+
+        return heapq.nlargest(k, scores, key=lambda i: (scores[i], -i))
+
+
+class BitsetIndex(Engine):
+    '''
+        Stores the recipe x ingredient matrix column-wise as Python big-int bitsets:
+        bit i of bitsets[ingredient] is set if recipe i uses the ingredient.
+        A query is a handful of ANDs over ints.
+    '''
+    def __init__(self, ingredient_sets):
+        columns = {}
+        size = 0
+        for i, ingredients in enumerate(ingredient_sets):
+            for ingredient in ingredients:
+                columns.setdefault(ingredient, []).append(i)
+            size += 1
+
+        # Pack every column into a little-endian bitmap and convert it in one go
+        n_bytes = (size + 7) // 8
+        bitsets = {}
+        for ingredient, ids in columns.iteritems():
+            bitmap = bytearray(n_bytes)
+            for i in ids:
+                bitmap[i >> 3] |= 1 << (i & 7)
+            bitmap.reverse()
+            bitsets[ingredient] = int(hexlify(bitmap), 16)
+
+        self.bitsets = bitsets
+        self.size = size
+        self.everything = (1 << size) - 1
+
+    def lookup(self, ingredients):
+        '''
+            Find all recipes which contain all ingredients
+            returns: sorted list of recipe indices (same as scan())
+        '''
+        bits = self.everything
+        for ingredient in ingredients:
+            bitset = self.bitsets.get(ingredient)
+            if bitset is None:
+                return []
+            bits &= bitset
+            if not bits:
+                return []
+
+        return bits_to_ids(bits)
+
@@ -0,0 +1,77 @@
+import json
+import pickle
+
+# The state machine as stored in the DB:
+# a magic prefix, a version byte and the values of STATE_KEYS as compact JSON.
+# Anything else is a legacy row (pickled dict from the former PickleType column).
+MAGIC = 'FW'
+VERSION = '1'
+STATE_KEYS = ('state', 'ingredient_list', 'recipe_list', 'recipe', 'step', 'confirm_for_restart')
+
+
+def encode_state(attributes):
+    '''
+        Encode the session attributes of the state machine (no copy needed)
+        returns: str
+    '''
+    values = [attributes.get(k) for k in STATE_KEYS]
+    return MAGIC + VERSION + json.dumps(values, separators=(',', ':'))
+
+
+def decode_state(data):
+    '''
+        Decode a state written by encode_state() or a legacy pickle
+        returns: dict of session attributes (empty if there is no state)
+    '''
+    if not data:
+        return {}
+
+    data = str(data)
+    if data.startswith(MAGIC):
+        version = data[len(MAGIC)]
+        if version != VERSION:
+            raise ValueError('Unknown state version {}'.format(version))
+        return dict(zip(STATE_KEYS, json.loads(data[len(MAGIC) + 1:])))
+
+    return pickle.loads(data)
+
+
+if __name__ == '__main__':
+    # Run from the repository root: python -m app.utils.state
+    import time
+    from copy import deepcopy
+
+    def legacy_encode(attributes):
+        return pickle.dumps(deepcopy(dict(attributes)), pickle.HIGHEST_PROTOCOL)
+
+    states = {
+        'cursor': {
+            'state': 'search', 'ingredient_list': [u'chicken', u'rice'],
+            'recipe_list': {'query': [u'chicken', u'rice'], 'seed': 2840127365, 'position': 3},
+            'recipe': 12345, 'step': 0, 'confirm_for_restart': False,
+        },
+        'full list': {
+            'state': 'search', 'ingredient_list': [u'chicken'],
+            'recipe_list': range(0, 25000, 7), 'recipe': 21, 'step': 0, 'confirm_for_restart': False,
+        },
+    }
+
+    n = 1000
+    for name, attributes in sorted(states.items()):
+        for format, encode, decode in (('pickle', legacy_encode, pickle.loads),
+                                       ('compact', encode_state, decode_state)):
+            data = encode(attributes)
+            assert decode(data) == attributes
+
+            before = time.time()
+            for i in range(n):
+                encode(attributes)
+            encoding = 1e6 * (time.time() - before) / n
+
+            before = time.time()
+            for i in range(n):
+                decode(data)
+            decoding = 1e6 * (time.time() - before) / n
+
+            print '{} ({}): {} bytes, encode {:.1f} us, decode {:.1f} us'.format(
+                name, format, len(data), encoding, decoding)
@@ -0,0 +1,350 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from .cache import LRUCache
+from .normalize import match_lines
+
+# Read-only binary recipe store, opened with mmap so all workers share the pages.
+#
+# Layout (all integers little-endian):
+#   header          magic, version, number of recipes, number of ingredients,
+#                   offset of the vocabulary, offset of the recipe offset table
+#   vocabulary      normalized ingredient names (UTF-8, separated by \0),
+#                   the position of a name is its ingredient id
+#   offset table    n + 1 uint64, the start of every recipe record
+#   records         per recipe: the end of every field (8 x uint32, relative
+#                   to the record) followed by the fields
+#
+# Fields: text is UTF-8, lists of text are separated by \0 and the normalized
+# ingredients are stored as uint32 ingredient ids. The line index maps
+# ingredients to their verbose line (see match_lines()) as uint32 pairs
+# (ingredient id, line).
+MAGIC = 'FWRS'
+VERSION = 2
+HEADER = struct.Struct('<4sIIIQQ')
+OFFSET = struct.Struct('<Q')
+FIELD_ENDS = struct.Struct('<8I')
+
+FIELDS = ('title', 'ingredient_lines', 'ingredients', 'steps', 'categories', 'country', 'author', 'line_index')
+LIST_FIELDS = ('ingredient_lines', 'steps', 'categories')
+
+
+def _pack_uint32(values):
+    '''
+        uint32 values as little-endian bytes (array('I') is 4 bytes in native order)
+    '''
+    values = array('I', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+def _unpack_uint32(data):
+    '''
+        returns: array('I') of little-endian uint32 bytes
+    '''
+    values = array('I', data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _utf8(text):
+    if text is None:
+        return ''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return str(text)
+
+
+def _utf8_list(texts):
+    if texts is None:
+        return ''
+    # Some recipes only have a single category
+    if isinstance(texts, basestring):
+        texts = [texts]
+    return '\0'.join(_utf8(t) for t in texts)
+
+
+def build_store(recipes, path):
+    '''
+        Convert recipes (in the pickle format, see recipes.py) into a store file.
+        The file is written next to path and moved into place when complete.
+    '''
+    # Integer ids for all normalized ingredients
+    vocabulary = sorted(set().union(*[recipe[1][1] for recipe in recipes]))
+    ingredient_ids = dict((ingredient, i) for i, ingredient in enumerate(vocabulary))
+    vocabulary = _utf8_list(vocabulary)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        vocabulary_offset = HEADER.size
+        table_offset = vocabulary_offset + len(vocabulary)
+        f.write(HEADER.pack(MAGIC, VERSION, len(recipes), len(ingredient_ids),
+                            vocabulary_offset, table_offset))
+        f.write(vocabulary)
+
+        # Reserve the offset table, it's filled in once all records are written
+        f.write('\0' * OFFSET.size * (len(recipes) + 1))
+
+        offsets = []
+        position = table_offset + OFFSET.size * (len(recipes) + 1)
+        for recipe in recipes:
+            ids = _pack_uint32(sorted(ingredient_ids[i] for i in recipe[1][1]))
+            lines = []
+            for ingredient, line in sorted(match_lines(recipe[1][0], recipe[1][1]).items()):
+                lines.extend((ingredient_ids[ingredient], line))
+            lines = _pack_uint32(lines)
+            fields = [
+                _utf8(recipe[0]),
+                _utf8_list(recipe[1][0]),
+                ids,
+                _utf8_list(recipe[2]),
+                _utf8_list(recipe[3]),
+                _utf8(recipe[4]),
+                _utf8(recipe[5]),
+                lines,
+            ]
+
+            ends = []
+            end = FIELD_ENDS.size
+            for field in fields:
+                end += len(field)
+                ends.append(end)
+
+            offsets.append(position)
+            f.write(FIELD_ENDS.pack(*ends))
+            f.write(''.join(fields))
+            position += end
+        offsets.append(position)
+
+        f.seek(table_offset)
+        f.write(''.join(OFFSET.pack(o) for o in offsets))
+
+    os.rename(tmp_path, path)
+
+
+class MappedCorpus(object):
+    '''
+        Read-only access to a store file built with build_store().
+        Nothing but the vocabulary is decoded upfront, single fields of
+        single recipes are decoded on access.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, size, n_ingredients, vocabulary_offset, table_offset = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError('{} is not a recipe store (version {}), rebuild it: python manage.py buildstore'.format(
+                path, VERSION))
+
+        self.size = size
+        self.table_offset = table_offset
+        vocabulary = self.mm[vocabulary_offset:table_offset].decode('utf-8')
+        self.vocabulary = vocabulary.split(u'\0') if n_ingredients else []
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.mm.close()
+
+    def __getitem__(self, i):
+        '''
+            Decode a complete recipe in the pickle format (see recipes.py)
+        '''
+        fields = self.fields(i)
+        return [
+            fields['title'],
+            [fields['ingredient_lines'], fields['ingredients']],
+            fields['steps'],
+            fields['categories'],
+            fields['country'],
+            fields['author'],
+        ]
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield self[i]
+
+    def _record(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError('recipe index out of range')
+        start, = OFFSET.unpack_from(self.mm, self.table_offset + OFFSET.size * i)
+        return start, FIELD_ENDS.unpack_from(self.mm, start)
+
+    def _decode(self, name, data):
+        if name == 'ingredients':
+            return frozenset(self.vocabulary[i] for i in _unpack_uint32(data))
+        if name == 'line_index':
+            pairs = _unpack_uint32(data)
+            return dict((self.vocabulary[pairs[j]], pairs[j + 1]) for j in xrange(0, len(pairs), 2))
+        data = data.decode('utf-8')
+        if name in LIST_FIELDS:
+            return data.split(u'\0') if data else []
+        if name == 'title':
+            return data
+        return data or None
+
+    def field(self, i, name):
+        '''
+            Decode a single field of a recipe (see FIELDS)
+        '''
+        start, ends = self._record(i)
+        n = FIELDS.index(name)
+        begin = start + (ends[n - 1] if n else FIELD_ENDS.size)
+        return self._decode(name, self.mm[begin:start + ends[n]])
+
+    def fields(self, i):
+        '''
+            Decode all fields of a recipe
+            returns: dict field name -> value
+        '''
+        start, ends = self._record(i)
+        begin = start + FIELD_ENDS.size
+        decoded = {}
+        for name, end in zip(FIELDS, ends):
+            decoded[name] = self._decode(name, self.mm[begin:start + end])
+            begin = start + end
+        return decoded
+
+    def ingredient_ids(self, i):
+        '''
+            The ingredient ids of a recipe (see vocabulary)
+        '''
+        start, ends = self._record(i)
+        n = FIELDS.index('ingredients')
+        return _unpack_uint32(self.mm[start + ends[n - 1]:start + ends[n]])
+
+    def ingredient_sets(self):
+        '''
+            Iterate over the normalized ingredients of all recipes (e.g. to build indices)
+        '''
+        vocabulary = self.vocabulary
+        for i in xrange(self.size):
+            yield frozenset(vocabulary[j] for j in self.ingredient_ids(i))
+
+    def facets(self):
+        '''
+            Iterate over the categories and the country of all recipes
+        '''
+        for i in xrange(self.size):
+            yield self.field(i, 'categories'), self.field(i, 'country')
+
+    def identities(self):
+        '''
+            Iterate over the title and the author of all recipes
+        '''
+        for i in xrange(self.size):
+            yield self.field(i, 'title'), self.field(i, 'author')
+
+
+class ListCorpus(object):
+    '''
+        Field access for recipes in the pickle format (all in memory).
+        Same interface as MappedCorpus.
+    '''
+    getters = {
+        'title': lambda recipe: recipe[0],
+        'ingredient_lines': lambda recipe: recipe[1][0],
+        'ingredients': lambda recipe: recipe[1][1],
+        'steps': lambda recipe: recipe[2],
+        'categories': lambda recipe: [recipe[3]] if isinstance(recipe[3], basestring) else recipe[3] or [],
+        'country': lambda recipe: recipe[4],
+        'author': lambda recipe: recipe[5],
+        'line_index': lambda recipe: match_lines(recipe[1][0], recipe[1][1]),
+    }
+
+    def __init__(self, recipes):
+        self.recipes = recipes
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def __getitem__(self, i):
+        return self.recipes[i]
+
+    def __iter__(self):
+        return iter(self.recipes)
+
+    def field(self, i, name):
+        if not 0 <= i < len(self.recipes):
+            raise IndexError('recipe index out of range')
+        return self.getters[name](self.recipes[i])
+
+    def ingredient_sets(self):
+        return (recipe[1][1] for recipe in self.recipes)
+
+    def facets(self):
+        categories, country = self.getters['categories'], self.getters['country']
+        return ((categories(recipe), country(recipe)) for recipe in self.recipes)
+
+    def identities(self):
+        return ((recipe[0], recipe[5]) for recipe in self.recipes)
+
+
+class LazyField(object):
+    '''
+        A recipe field which is decoded on first access and then kept on the recipe.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.slot = '_' + name
+
+    def __get__(self, recipe, owner):
+        if recipe is None:
+            return self
+        try:
+            return getattr(recipe, self.slot)
+        except AttributeError:
+            value = recipe.corpus.field(recipe.id, self.name)
+            setattr(recipe, self.slot, value)
+            return value
+
+
+class Recipe(object):
+    '''
+        A view of a single recipe, fields are only decoded when used.
+    '''
+    __slots__ = ('id', 'corpus') + tuple('_' + name for name in FIELDS)
+
+    title = LazyField('title')
+    ingredient_lines = LazyField('ingredient_lines')
+    ingredients = LazyField('ingredients')
+    steps = LazyField('steps')
+    categories = LazyField('categories')
+    country = LazyField('country')
+    author = LazyField('author')
+    line_index = LazyField('line_index')
+
+    def __init__(self, corpus, id):
+        self.id = id
+        self.corpus = corpus
+
+
+class RecipeStore(object):
+    '''
+        Hands out Recipe views of a corpus (MappedCorpus or ListCorpus).
+        The recipes used most recently (e.g. the ones currently being cooked)
+        stay decoded in a bounded LRU cache.
+    '''
+    def __init__(self, corpus, cache_size=512):
+        self.corpus = corpus
+        self.cache = LRUCache(cache_size)
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __getitem__(self, i):
+        recipe = self.cache.get(i)
+        if recipe is None:
+            if not 0 <= i < len(self.corpus):
+                raise IndexError('recipe index out of range')
+            recipe = Recipe(self.corpus, i)
+            self.cache.put(i, recipe)
+        return recipe
@@ -1,13 +1,25 @@
-from copy import deepcopy
+import cProfile
+import json
+import logging
+import pstats
+import time
 from random import choice
+from StringIO import StringIO
 
-from flask import render_template
-from flask_ask import statement, question, session
+from flask import render_template, g, request as flask_request
+from flask_ask import statement, question, session, request
 
-from . import alexa, db
-from .utils.recipes import find_recipes, all_recipes
-from .dialog import reply, recipe_card
-from .models import User
+from . import alexa, main
+from .persistence import state_writer
+from .utils.recipes import recipe_store, new_cursor, cursor_size, cursor_recipe, cursor_recipes, SearchOverloaded
+from .utils.recipes import facet_terms, resolve_ingredient
+from .utils.recipes import generation, generations, legacy_recipe, search_pool, STABLE_IDS
+from .utils.metrics import metrics, BYTES
+from .utils.normalize import normalize_ingredient
+from .utils.state import encode_state, decode_state, STATE_KEYS
+from .dialog import reply, recipe_card, rendered
+
+log = logging.getLogger(__name__)
 
 
 #####
@@ -16,69 +28,142 @@ from .models import User
 #
 ####
 
-def load_state(user):
+def load_state(state):
     '''
-        Loads the current state from the DB and sets session.attributes
+        Loads an encoded state (from the DB) and sets session.attributes
+        returns: False if it can't be used (the caller resets the state)
     '''
-    for k, v in user.state_machine.items():
+    try:
+        attributes = decode_state(state)
+    except Exception:
+        # Unknown version or an unreadable legacy pickle
+        log.warning('Could not decode the state of %s, resetting it', session.user['userId'], exc_info=True)
+        return False
+
+    for k, v in attributes.items():
         session.attributes[k] = v
 
     # Check if the session is correctly loaded...
     all_keys = session.attributes.keys()
-    for k in ['state','ingredient_list','recipe_list','recipe','step','confirm_for_restart']:
+    for k in STATE_KEYS:
         if k not in all_keys:
             break
     else:
-        return True
+        return migrate_state()
 
     return False
 
 
-def save_state(user):
+def migrate_state():
+    '''
+        Older states kept the complete list of recipes found (the order is lost,
+        we search again for the same ingredients) or a cursor without position,
+        and recipe indices instead of stable recipe ids.
+    '''
+    sess = session.attributes
+    sess['recipe'] = legacy_recipe(sess['recipe'])
+
+    # Removed from the corpus (and no older generation is kept)
+    if sess['recipe'] != -1 and sess['recipe'] not in recipe_store:
+        return False
+
+    cursor = sess['recipe_list']
+    if not cursor:
+        sess['recipe_list'] = None
+        return True
+
+    if isinstance(cursor, list):
+        cursor = new_cursor(sess['ingredient_list'])
+    elif 'position' in cursor:
+        return True
+
+    # Find the position of the current recipe once
+    recipes = cursor_recipes(cursor)
+    if sess['recipe'] in recipes:
+        cursor['position'] = recipes.index(sess['recipe'])
+    elif sess['state'] in ('search', 'prepare'):
+        return False
+    else:
+        cursor['position'] = 0
+
+    sess['recipe_list'] = cursor
+    return True
+
+
+def move(offset):
     '''
-        Save the current state to the DB
+        Move to another recipe in the search results (wraps around)
+        returns: False if there are no results anymore (the search is reset)
+    '''
+    sess = session.attributes
+    cursor = sess['recipe_list']
+    size = cursor_size(cursor) if cursor else 0
+
+    # The results may be gone after the corpus was reloaded
+    if not size:
+        reset_search()
+        return False
+
+    cursor['position'] = (cursor['position'] + offset) % size
+    sess['recipe'] = cursor_recipe(cursor)
+    return True
+
+
+def save_state():
+    '''
+        Save the current state to the DB (possibly write-behind)
     '''
     if session.attributes.get('state', False):
-        user.state_machine = deepcopy(dict(session.attributes))
+        state_writer.save(session.user['userId'], encode_state(session.attributes))
+
+
+def reset_search():
+    session.attributes['state'] = 'ingredients'
+    session.attributes['recipe_list'] = None
+    session.attributes['recipe'] = -1
 
 
 def reset_state():
     session.attributes['state'] = 'ingredients'
     session.attributes['ingredient_list'] = []
-    session.attributes['recipe_list'] = []
+    session.attributes['recipe_list'] = None # Search cursor, see new_cursor()
     session.attributes['recipe'] = -1
     session.attributes['step'] = 0 # Step is used both during prepare and cook to keep track of the current step
     session.attributes['confirm_for_restart'] = False # Need to roll our own confirmation dialog...
 
 
+def resume_session():
+    '''
+        Start or resume the session (first thing of every handler).
+        Sessions which were live during the deploy still send all results
+        and recipe indices: migrate them like stored states.
+    '''
+    sess = session.attributes
+    if not sess.get('state', False):
+        start_session()
+    elif isinstance(sess.get('recipe_list'), list) or 0 <= sess.get('recipe', -1) < STABLE_IDS:
+        if not migrate_state():
+            reset_search()
+
+
 def start_session():
     '''
         This starts or resumes a previous session.
         Typically happens when the user (re-)enters the skill.
     '''
-    user_id = session.user['userId']
-    user = User.query.get(user_id)
+    state = state_writer.load(session.user['userId'])
 
     # Complete reset only if new user
-    if user == None:
+    if state is None:
         reset_state()
 
-        # Create new user and save state
-        user = User(user_id = user_id)
-        db.session.add(user)
-        save_state(user)
-
     # Resume from last time
-    else:
-        user.update_online()
-        success = load_state(user)
-
-        # If something is not ok, reset everything...
-        if not success:
-            reset_state()
-            save_state(user)
+    # If something is not ok, reset everything...
+    elif not load_state(state):
+        reset_state()
 
-    db.session.commit()
+    # Creates new users and updates when we've last seen them
+    save_state()
 
 
 #####
@@ -91,8 +176,8 @@ def start_session():
 def launched():
     # Start session if not already done
     if not session.attributes.get('state', False):
-        print 'Todo: Investigate why this happens'
-        start_session()
+        metrics.inc('foodworld_launch_without_state_total')
+    resume_session()
 
     if session.attributes['state'] == 'ingredients':
         answer = '''
@@ -118,8 +203,7 @@ def new_session():
         Reset the state. (we start by selecting ingredients)
     '''
     # Start session if not already done
-    if not session.attributes.get('state'):
-        start_session()
+    resume_session()
 
 
 @alexa.intent('AMAZON.HelpIntent')
@@ -134,25 +218,19 @@ def help():
 
 @alexa.intent('AMAZON.CancelIntent')
 def cancel():
-    user = User.query.get(session.user['userId'])
-    save_state(user)
-    db.session.commit()
+    save_state()
     return statement('Thanks for using food world!')
 
 
 @alexa.intent('AMAZON.StopIntent')
 def stop():
-    user = User.query.get(session.user['userId'])
-    save_state(user)
-    db.session.commit()
+    save_state()
     return statement('Thanks for using food world!')
 
 
 @alexa.session_ended
 def session_ended():
-    user = User.query.get(session.user['userId'])
-    save_state(user)
-    db.session.commit()
+    save_state()
     return statement('Thanks for using food world!')
 
 
@@ -166,7 +244,7 @@ def session_ended():
 # step                  relevant for keeping track of ingredient and cooking steps
 # ingredient_list           all the ingredients the user wants to cook with
 # recipe                the selected recipe
-# recipe_list           in search we only calculate recipes once
+# recipe_list           cursor of the last search (query, shuffle seed and position), not the recipes
 #
 #####
 
@@ -178,8 +256,7 @@ def confirm():
         Confirm a question
         Used in search, prepare and cook
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
     state = sess.get('state')
@@ -202,11 +279,11 @@ def confirm():
 
     # Check all the ingredients
     elif state == 'prepare':
-        recipe = all_recipes[sess['recipe']]
+        recipe = recipe_store[sess['recipe']]
 
         # Advance among the list of ingredients
         # Reply() will handle if less than three are left...
-        max_step = len(recipe[1][0]) - 1
+        max_step = len(recipe.ingredient_lines) - 1
 
         # Done with all the ingredients
         if sess['step'] + 4 >= max_step:
@@ -231,8 +308,7 @@ def deny():
         Deny a question
         Used in search and prepare
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
     state = sess.get('state')
@@ -254,12 +330,10 @@ def deny():
     # No in search = move to next recipe
     # No in prepare = also move to next recipe
     elif state in ('search', 'prepare'):
-        next = (sess['recipe_list'].index(sess['recipe']) + 1) % len(sess['recipe_list'])
-        sess['recipe'] = sess['recipe_list'][next]
-
-        # Needed for prepare
-        sess['state'] = 'search'
-        send_card = True
+        # Needed for prepare (unless the results are gone)
+        if move(1):
+            sess['state'] = 'search'
+            send_card = True
 
     else:
         return question('Ok with me...')
@@ -278,8 +352,7 @@ def repeat():
         Repeat the last statement.
         Used in search, prepare and cook.
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     # The simplest of them all, no changes to state machine = same result:)
     return question(reply())
@@ -292,30 +365,28 @@ def back():
 
         Used in cook or search
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
     state = sess['state']
 
     # Previous in cook
     if state == 'cook':
-        recipe = all_recipes[sess['recipe']]
+        recipe = recipe_store[sess['recipe']]
 
         if sess['step'] > 0:
             sess['step'] -= 1
 
     # Previous in prepare
     elif state == 'prepare':
-        recipe = all_recipes[sess['recipe']]
+        recipe = recipe_store[sess['recipe']]
         sess['step'] -= 4
         if sess['step'] < 0:
             sess['step'] = 0
 
     # Previous in search
     elif state == 'search':
-        next = (sess['recipe_list'].index(sess['recipe']) - 1) % len(sess['recipe_list'])
-        sess['recipe'] = sess['recipe_list'][next]
+        move(-1)
 
     else:
         return question('Fine with me!')
@@ -328,30 +399,27 @@ def next():
     '''
         "next step"
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
     state = sess['state']
 
     if state == 'cook':
-        recipe = all_recipes[sess['recipe']]
+        recipe = recipe_store[sess['recipe']]
         sess['step'] += 1
 
         # Finished cooking (app & session ends)
-        if sess['step'] >= len(recipe[2]):
+        if sess['step'] >= len(recipe.steps):
             # We reset the state and save it
             reset_state()
-            save_state(User.query.get(session.user['userId']))
-            db.session.commit()
+            save_state()
 
-            answer = u'Your done preparing {}! Thanks for using food world and enjoy your meal!'.format(recipe[0])
+            answer = u'Your done preparing {}! Thanks for using food world and enjoy your meal!'.format(recipe.title)
             return statement(answer)
 
     # Next in search = new recipe
     elif state == 'search':
-        next = (sess['recipe_list'].index(sess['recipe']) + 1) % len(sess['recipe_list'])
-        sess['recipe'] = sess['recipe_list'][next]
+        move(1)
 
     else:
         return question('Fine with me!')
@@ -369,11 +437,13 @@ def add_ingredient(ingredient):
     if ingredient is None:
         return question('Please specify an ingredient, for example: alexa, add parsley.')
 
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
 
+    # The ingredient meant, e.g. tomato if "tomatoe" was understood
+    ingredient = resolve_ingredient(ingredient)
+
     # Add ingredient to ingredient_list
     if ingredient not in sess['ingredient_list']:
         sess['ingredient_list'].append(ingredient)
@@ -397,11 +467,15 @@ def remove_ingredient(ingredient):
     if ingredient is None:
         return question('Please specify an ingredient, for example: alexa, remove coconut.')
 
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
 
+    # Added as the ingredient meant (see add_ingredient)
+    resolved = resolve_ingredient(ingredient)
+    if resolved in sess['ingredient_list']:
+        ingredient = resolved
+
     # Add ingredient to ingredient_list
     if ingredient not in sess['ingredient_list']:
         prefix = ingredient + u' is not on the ingredient list. '
@@ -414,14 +488,14 @@ def remove_ingredient(ingredient):
 
 
 @alexa.intent('SearchIntent')
-def search():
+def search(category, country, ingredient):
     '''
-        "Search recipes"
+        "Search recipes", "Find a thai dessert with coconut"
 
-        Based on previously collected ingredient list
+        Based on previously collected ingredient list,
+        optionally only recipes of a category and/or a country
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
     state = sess.get('state')
@@ -429,16 +503,37 @@ def search():
     if not state:
         return question(reply())
 
+    # "... with coconut" also adds the ingredient
+    if ingredient is not None:
+        ingredient = resolve_ingredient(ingredient)
+    if ingredient is not None and ingredient not in sess['ingredient_list']:
+        sess['ingredient_list'].append(ingredient)
+    facets = facet_terms([category], country)
+
     # Search for recipes
-    if len(sess['ingredient_list']) > 0:
+    if len(sess['ingredient_list']) > 0 or facets:
         # Search for recipes
-        recipes = find_recipes(sess['ingredient_list'])
-
-        if recipes:
+        cursor = new_cursor(sess['ingredient_list'], facets=facets)
+        # The last search (unless it's a list of a session live during the deploy)
+        previous = sess['recipe_list'] if isinstance(sess['recipe_list'], dict) else None
+        try:
+            found = cursor_size(cursor, offload=True, previous=previous)
+
+            # No recipe has all ingredients, offer those sharing the most
+            if not found and len(sess['ingredient_list']) > 1:
+                cursor = new_cursor(sess['ingredient_list'], ranked=True, facets=facets)
+                found = cursor_size(cursor, offload=True)
+        except SearchOverloaded:
+            return question(u'Sorry, searching takes too long right now. Please try again: alexa, search recipes.')
+
+        if found:
             # Update the state machine
             sess['state'] = 'search'
-            sess['recipe_list'] = recipes
-            sess['recipe'] = recipes[0]
+            sess['recipe_list'] = cursor
+            sess['recipe'] = cursor_recipe(cursor)
+
+        elif not sess['ingredient_list']:
+            return question(u'Could not find a recipe like that. Try another category or country.')
 
         else:
             answer = u'Could not find a recipe. Try removing an ingredient, your current list is: '
@@ -465,16 +560,17 @@ def clarification(ingredient):
     if ingredient is None:
         return question('Please specify an ingredient, for example: alexa, how much bread did i need?')
 
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     sess = session.attributes
-    recipe = all_recipes[sess['recipe']]
-
-    for line in recipe[1][0]:
-        if ingredient in line:
-            answer = u'You need ' + line + u'. Repeat the last step using: alexa, repeat.'
-            break
+    if sess['recipe'] == -1:
+        return question(u'Select a recipe first. Search for recipes using: alexa, search recipes.')
+    recipe = recipe_store[sess['recipe']]
+
+    # Same normalization as the search (salt etc. are only ignored by the search)
+    line = recipe.line_index.get(normalize_ingredient(ingredient) or ingredient.lower())
+    if line is not None:
+        answer = u'You need ' + recipe.ingredient_lines[line] + u'. Repeat the last step using: alexa, repeat.'
     else:
         answer = u'Could not find any {} in this recipe.'.format(ingredient)
 
@@ -488,8 +584,71 @@ def restart():
 
         We need to implement our own confirmation bc its only available in Builder Beta:(
     '''
-    if not session.attributes.get('state', False):
-        start_session()
+    resume_session()
 
     session.attributes['confirm_for_restart'] = True
-    return question('Restarting ends the current recipe and resets the ingredients. Are you sure?')
\ No newline at end of file
+    return question('Restarting ends the current recipe and resets the ingredients. Are you sure?')
+
+
+#####
+#
+# Monitoring
+#
+#####
+
+def request_name():
+    '''
+        The intent (or type) of the current alexa request, None for other requests
+    '''
+    try:
+        if request.type == 'IntentRequest':
+            return request.intent.name
+        return request.type
+    except Exception:
+        return None
+
+
+@main.before_app_request
+def start_measuring():
+    measure, profile = metrics.next_request()
+    if measure:
+        g.metrics_start = time.time()
+    if profile:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@main.after_app_request
+def stop_measuring(response):
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        stream = StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+        log.info('Profile of %s %s\n%s', flask_request.path, request_name(), stream.getvalue())
+
+    start = getattr(g, 'metrics_start', None)
+    name = request_name()
+    if start is None or name is None:
+        return response
+
+    metrics.observe('foodworld_request_seconds', time.time() - start, intent=name)
+    metrics.observe('foodworld_session_bytes', len(json.dumps(session.attributes)), BYTES, intent=name)
+    return response
+
+
+@main.route('/metrics')
+def prometheus_metrics():
+    gauges = {}
+    current = generation()
+    gauges['foodworld_corpus_generation'] = current.number
+    gauges['foodworld_corpus_generations'] = len(generations)
+    for prefix, stats in (('foodworld_search_cache_', current.cache.stats()),
+                          ('foodworld_recipe_cache_', current.store.cache.stats()),
+                          ('foodworld_render_cache_', rendered.stats()),
+                          ('foodworld_user_cache_', state_writer.stats()),
+                          ('foodworld_search_pool_', search_pool.stats())):
+        for k, v in stats.items():
+            gauges[prefix + k] = v
+
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -1,7 +1,37 @@
+import gc
+import logging
 import os
 
-from app import create_app
+from app import create_app, db
+from app.utils.recipes import generation
+from app.utils.store import MappedCorpus
+from config import basedir
+
+log = logging.getLogger(__name__)
 
 # Create an application instance that web servers can use.
-# TODO: make this production!!
-application = app = create_app('development')
\ No newline at end of file
+# Gunicorn preloads it in the master (see webserver/gunicorn.conf.py):
+# the recipes and indices are loaded once and shared copy-on-write by the workers.
+application = app = create_app(os.environ.get('FLASK_CONFIG') or 'production')
+
+# Every request would fail otherwise. Gunicorn used to run with the development
+# config, its users are in data-dev.sqlite (keep them with DATABASE_URL).
+with app.app_context():
+    if not db.engine.has_table('users'):
+        raise RuntimeError(
+            '{} has no users table. Create it: FLASK_CONFIG={} python manage.py createdb, '
+            'or keep using the development DB: DATABASE_URL=sqlite:///{}'.format(
+                app.config['SQLALCHEMY_DATABASE_URI'], os.environ.get('FLASK_CONFIG') or 'production',
+                os.path.join(basedir, 'data-dev.sqlite')))
+
+# The pickled recipes are millions of Python objects on the heap, the workers
+# copy every page the garbage collector touches (the store is mapped instead).
+if not isinstance(generation().corpus, MappedCorpus):
+    log.warning('Serving the recipes from the pickle, build the store so the workers '
+                'can share them: python manage.py buildstore')
+
+# Everything loaded so far lives as long as the process. Full collections
+# walk (and so copy) all of it, make them 100 times rarer in the workers.
+gc.collect()
+threshold0, threshold1, threshold2 = gc.get_threshold()
+gc.set_threshold(threshold0, threshold1, threshold2 * 100)
@@ -0,0 +1,81 @@
+'''
+    Load test of the state persistence: commits per second with the
+    default SQLite setup (get-then-add, rollback journal) and with the
+    production tuning (WAL, synchronous=NORMAL, upsert).
+
+    Run from the repository root: python benchmarks/db_commits.py
+'''
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, db
+from app.persistence import state_writer
+from app.utils.state import encode_state
+from config import config, TestingConfig, ProductionConfig
+
+
+def make_config(name, base, path, **options):
+    class LoadTestConfig(base):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        SQLALCHEMY_RECORD_QUERIES = False
+        PERSIST_WRITE_BEHIND = False
+    for k, v in options.items():
+        setattr(LoadTestConfig, k, v)
+
+    config[name] = LoadTestConfig
+    return name
+
+
+def run(config_name, users, saves, threads):
+    app = create_app(config_name)
+    with app.app_context():
+        db.create_all()
+
+    state = encode_state({
+        'state': 'search', 'ingredient_list': [u'chicken', u'rice'],
+        'recipe_list': {'query': [u'chicken', u'rice'], 'seed': 1, 'position': 0},
+        'recipe': 42, 'step': 0, 'confirm_for_restart': False,
+    })
+
+    def work(worker):
+        with app.app_context():
+            for i in range(saves):
+                for u in range(worker, users, threads):
+                    state_writer.save('user-{}'.format(u), state)
+
+    before = time.time()
+    workers = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    duration = time.time() - before
+
+    return users * saves / duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--saves', type=int, default=5, help='saves per user')
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    modes = [
+        ('before', make_config('loadtest-before', TestingConfig, os.path.join(directory, 'before.sqlite'),
+                               PERSIST_UPSERT=False)),
+        ('after', make_config('loadtest-after', ProductionConfig, os.path.join(directory, 'after.sqlite'),
+                              PERSIST_UPSERT=True)),
+    ]
+
+    for label, config_name in modes:
+        rate = run(config_name, args.users, args.saves, args.threads)
+        print '{}: {:.0f} commits/s ({} users x {} saves, {} threads)'.format(
+            label, rate, args.users, args.saves, args.threads)
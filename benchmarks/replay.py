@@ -0,0 +1,321 @@
+'''
+    Replays realistic conversations with the skill (unsigned Alexa requests):
+    launch, add a few ingredients, search (removing ingredients until
+    something is found), browse the results, prepare and cook the recipe,
+    then stop or end the session. The intents and slots come from
+    alexa/intents.json and alexa/utterances.txt, the ingredients from
+    alexa/ingredients.txt.
+
+    In-process through the test client of create_app('testing'):
+        python benchmarks/replay.py --conversations 500 --threads 4
+    Or over HTTP (the server must not verify signatures, its DB must exist):
+        FLASK_CONFIG=production python manage.py createdb
+        ASK_VERIFY_REQUESTS=off sh webserver/gunicorn.sh
+        python benchmarks/replay.py --url http://127.0.0.1:4999/
+
+    Reports the throughput and the latency percentiles per intent.
+'''
+import argparse
+import codecs
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+APPLICATION_ID = 'amzn1.ask.skill.replay'
+
+
+def load_intents():
+    '''
+        returns: {intent: [slot names]} of the intents with sample utterances
+    '''
+    with open(os.path.join(ROOT, 'alexa/intents.json')) as f:
+        schema = json.load(f)
+
+    uttered = set()
+    with codecs.open(os.path.join(ROOT, 'alexa/utterances.txt'), 'r', 'utf-8') as f:
+        for line in f:
+            if line.strip():
+                uttered.add(line.split()[0])
+
+    return dict((intent['intent'], [slot['name'] for slot in intent.get('slots', [])])
+                for intent in schema['intents']
+                if intent['intent'] in uttered or intent['intent'].startswith('AMAZON.'))
+
+
+def load_ingredients():
+    with codecs.open(os.path.join(ROOT, 'alexa/ingredients.txt'), 'r', 'utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class HTTPClient(object):
+    def __init__(self, url):
+        self.url = url
+
+    def post(self, body):
+        request = urllib2.Request(self.url, body, {'Content-Type': 'application/json'})
+        return json.loads(urllib2.urlopen(request).read())
+
+
+class TestClient(object):
+    '''
+        Requests through the Flask test client (thread-safe, one per thread)
+    '''
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, body):
+        response = self.client.post('/', data=body, content_type='application/json')
+        if response.status_code != 200:
+            raise IOError('HTTP {}'.format(response.status_code))
+        return json.loads(response.data)
+
+
+class Conversation(object):
+    '''
+        One session of a user: builds the request envelopes and keeps the
+        session attributes between requests like Alexa does.
+    '''
+    def __init__(self, client, intents, user_id, timings):
+        self.client = client
+        self.intents = intents
+        self.user_id = user_id
+        self.timings = timings
+        self.session_id = 'amzn1.echo-api.session.' + str(uuid.uuid4())
+        self.attributes = {}
+        self.new = True
+        self.ended = False
+
+    @property
+    def state(self):
+        return self.attributes.get('state')
+
+    def envelope(self, request):
+        request.update({
+            'requestId': 'amzn1.echo-api.request.' + str(uuid.uuid4()),
+            'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'locale': 'en-US',
+        })
+        return json.dumps({
+            'version': '1.0',
+            'session': {
+                'new': self.new,
+                'sessionId': self.session_id,
+                'application': {'applicationId': APPLICATION_ID},
+                'attributes': self.attributes,
+                'user': {'userId': self.user_id},
+            },
+            'request': request,
+        })
+
+    def send(self, name, request):
+        body = self.envelope(request)
+        self.new = False
+
+        before = time.time()
+        try:
+            response = self.client.post(body)
+        except Exception:
+            self.timings.error(name)
+            self.ended = True
+            return
+        self.timings.add(name, time.time() - before)
+
+        self.attributes = response.get('sessionAttributes') or {}
+        if response['response'].get('shouldEndSession'):
+            self.ended = True
+
+    def launch(self):
+        self.send('LaunchRequest', {'type': 'LaunchRequest'})
+
+    def intent(self, name, **slots):
+        if name not in self.intents:
+            raise ValueError('Unknown intent {}'.format(name))
+        if self.ended:
+            return
+
+        self.send(name, {
+            'type': 'IntentRequest',
+            'intent': {
+                'name': name,
+                'slots': dict((slot, {'name': slot, 'value': slots.get(slot)}) for slot in self.intents[name]),
+            },
+        })
+
+    def end(self):
+        if not self.ended:
+            self.send('SessionEndedRequest', {'type': 'SessionEndedRequest', 'reason': 'USER_INITIATED'})
+            self.ended = True
+
+
+def converse(conversation, ingredients, rand):
+    '''
+        A realistic walk through the state machine
+    '''
+    conversation.launch()
+    if conversation.state != 'ingredients':
+        conversation.intent('RestartIntent')
+        conversation.intent('YesIntent')
+
+    for i in range(rand.randint(1, 3)):
+        conversation.intent('AddIntent', ingredient=rand.choice(ingredients))
+    conversation.intent('SearchIntent')
+
+    # Nothing found: remove the last ingredient (or try another one)
+    for attempt in range(3):
+        if conversation.ended or conversation.state == 'search':
+            break
+        added = conversation.attributes.get('ingredient_list') or []
+        if len(added) > 1:
+            conversation.intent('RemoveIntent', ingredient=added[-1])
+        else:
+            conversation.intent('AddIntent', ingredient=rand.choice(ingredients))
+        conversation.intent('SearchIntent')
+
+    if conversation.state == 'search':
+        for i in range(rand.randint(0, 4)):
+            conversation.intent(rand.choice(['NoIntent', 'NextIntent', 'NextIntent', 'PreviousIntent', 'RepeatIntent']))
+        conversation.intent('YesIntent')
+
+        for i in range(10):
+            if conversation.state != 'prepare':
+                break
+            if rand.random() < 0.2:
+                conversation.intent('ClarificationIntent', ingredient=rand.choice(conversation.attributes['ingredient_list']))
+            conversation.intent('YesIntent')
+
+        # Cook some (or all) steps, NextIntent after the last step ends the session
+        for i in range(rand.randint(1, 20)):
+            if conversation.state != 'cook':
+                break
+            conversation.intent(rand.choice(['NextIntent'] * 6 + ['RepeatIntent', 'PreviousIntent', 'AMAZON.HelpIntent']))
+
+    if rand.random() < 0.5:
+        conversation.intent('AMAZON.StopIntent')
+    conversation.end()
+
+
+class Timings(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, name, duration):
+        with self.lock:
+            self.durations[name].append(duration)
+
+    def error(self, name):
+        with self.lock:
+            self.errors[name] += 1
+
+    def report(self, elapsed):
+        names = sorted(set(self.durations) | set(self.errors))
+        report = {}
+        for name in names + ['all']:
+            if name == 'all':
+                durations = sorted(sum(self.durations.values(), []))
+                errors = sum(self.errors.values())
+            else:
+                durations = sorted(self.durations[name])
+                errors = self.errors[name]
+
+            pick = lambda p: 1000 * durations[min(len(durations) - 1, int(p * len(durations)))] if durations else None
+            report[name] = {
+                'requests': len(durations),
+                'errors': errors,
+                'per_second': len(durations) / elapsed,
+                'p50_ms': pick(0.5),
+                'p90_ms': pick(0.9),
+                'p99_ms': pick(0.99),
+                'max_ms': pick(1.0),
+            }
+        return report
+
+
+def testing_app(database):
+    '''
+        The testing app with its own DB file (the in-memory DB is per connection)
+    '''
+    from app import create_app, db
+    from config import config, TestingConfig
+
+    class ReplayConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database
+        SQLALCHEMY_RECORD_QUERIES = False
+    config['replay'] = ReplayConfig
+
+    app = create_app('replay')
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='replay over HTTP instead of in-process')
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50, help='distinct users (returning users resume their state)')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the report as JSON')
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    intents = load_intents()
+    ingredients = load_ingredients()
+
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)
+    else:
+        app = testing_app(os.path.join(tempfile.mkdtemp(), 'replay.sqlite'))
+        make_client = lambda: TestClient(app)
+
+    timings = Timings()
+    counter = iter(xrange(args.conversations))
+    counter_lock = threading.Lock()
+
+    def work(worker):
+        client = make_client()
+        rand = random.Random(args.seed * 1000 + worker)
+        while True:
+            with counter_lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            user_id = 'amzn1.ask.account.replay-{}'.format(rand.randrange(args.users))
+            converse(Conversation(client, intents, user_id, timings), ingredients, rand)
+
+    before = time.time()
+    workers = [threading.Thread(target=work, args=(t,)) for t in range(args.threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - before
+
+    report = timings.report(elapsed)
+    print '{} conversations in {:.1f} s ({:.1f}/s), {} threads'.format(
+        args.conversations, elapsed, args.conversations / elapsed, args.threads)
+    print '{:<22} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'request', 'count', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for name, row in sorted(report.items(), key=lambda item: item[0] == 'all'):
+        print '{:<22} {requests:>8} {errors:>6} {per_second:>8.1f} {p50:>8} {p90:>8} {p99:>8} {max:>8}'.format(
+            name, requests=row['requests'], errors=row['errors'], per_second=row['per_second'],
+            **dict((k, '-' if row[k + '_ms'] is None else '{:.1f}'.format(row[k + '_ms']))
+                   for k in ('p50', 'p90', 'p99', 'max')))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
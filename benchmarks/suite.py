@@ -0,0 +1,277 @@
+'''
+    Reproducible benchmarks on a synthetic recipe corpus.
+
+    Generates recipes in the pickle format (see app/utils/recipes.py) with
+    ingredients from alexa/ingredients.txt drawn from a Zipf distribution,
+    then measures (every measurement in a fresh process):
+        load        startup time and RSS with the pickle and the mapped store
+        search      latency percentiles per engine by selectivity of the query
+        session     encoding and decoding the state machine
+    The results are written as JSON so runs can be compared.
+
+    Run from the repository root: python benchmarks/suite.py --size 25000
+'''
+import argparse
+import codecs
+import json
+import os
+import pickle
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CATEGORIES = [u'Dessert', u'Main Dish', u'Soup', u'Salad', u'Side Dish', u'Breakfast', u'Appetizer', u'Bread']
+COUNTRIES = [None, u'Thai', u'Italian', u'Mexican', u'Indian', u'French', u'Japanese', u'Greek']
+UNITS = [u'1 cup', u'2 cups', u'1 tbsp', u'2 tsp', u'200 g', u'1 pinch of', u'3', u'1/2 cup']
+
+# Number of matches for the selectivity classes of the queries
+SELECTIVITY = [('rare', 10), ('narrow', 100), ('medium', 1000), ('broad', None)]
+
+
+def vocabulary():
+    '''
+        Normalized ingredients: the slot values normalized like the queries
+        (without the ignored ones), so every ingredient can be found
+    '''
+    from app.utils.normalize import normalize_ingredient
+
+    values = codecs.open(os.path.join(ROOT, 'alexa/ingredients.txt'), 'r', 'utf-8').read().split(u'\n')
+    normalized = set(normalize_ingredient(v.strip()) for v in values if v.strip())
+    normalized.discard(None)
+    return sorted(normalized)
+
+
+class Zipf(object):
+    '''
+        Draws ingredients with P(rank r) ~ 1 / r^s
+    '''
+    def __init__(self, items, s, rand):
+        self.items = items
+        self.rand = rand
+        self.cumulative = []
+        total = 0.0
+        for r in range(1, len(items) + 1):
+            total += 1.0 / r ** s
+            self.cumulative.append(total)
+
+    def sample(self, k):
+        found = set()
+        while len(found) < k:
+            x = self.rand.random() * self.cumulative[-1]
+            found.add(self.items[bisect_left(self.cumulative, x)])
+        return found
+
+
+def synthetic_corpus(size, seed, s=1.1):
+    rand = random.Random(seed)
+    ingredients = vocabulary()
+    rand.shuffle(ingredients)
+    zipf = Zipf(ingredients, s, rand)
+
+    recipes = []
+    for i in xrange(size):
+        used = zipf.sample(rand.randint(3, 15))
+        lines = [u'{} {}'.format(rand.choice(UNITS), ingredient) for ingredient in used]
+        steps = [u'step {} of recipe {}: mix {} well'.format(j + 1, i, rand.choice(lines))
+                 for j in range(rand.randint(2, 12))]
+        recipes.append([
+            u'Synthetic recipe {}'.format(i),
+            [lines, used],
+            steps,
+            rand.sample(CATEGORIES, rand.randint(0, 2)),
+            rand.choice(COUNTRIES),
+            rand.choice([None, u'user{}'.format(rand.randint(1, 5000))]),
+        ])
+    return recipes, zipf
+
+
+def rss():
+    '''
+        Resident memory of this process in bytes
+    '''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    pick = lambda p: timings[min(len(timings) - 1, int(p * len(timings)))]
+    return {
+        'n': len(timings),
+        'p50_ms': 1000 * pick(0.5),
+        'p90_ms': 1000 * pick(0.9),
+        'p99_ms': 1000 * pick(0.99),
+        'max_ms': 1000 * timings[-1],
+    }
+
+
+#####
+#
+# Phases (each runs in its own process, see run_phase)
+#
+#####
+
+def phase_build(args):
+    from app.utils.store import build_store
+    recipes = pickle.load(open(args.pickle, 'rb'))
+    before = time.time()
+    build_store(recipes, args.store)
+    return {'build_store_s': time.time() - before, 'store_bytes': os.path.getsize(args.store)}
+
+
+def phase_load(args):
+    # Not part of loading the recipes
+    import flask, flask_ask, flask_sqlalchemy
+
+    before_rss, before = rss(), time.time()
+    from app.utils import recipes
+    corpus = recipes.generation().corpus
+    return {
+        'corpus': type(corpus).__name__,
+        'recipes': len(corpus),
+        'load_s': time.time() - before,
+        'rss_bytes': rss() - before_rss,
+    }
+
+
+def phase_search(args):
+    from app.utils import recipes
+    from app.utils.normalize import normalize_ingredients
+
+    rand = random.Random(args.seed)
+    _, zipf = synthetic_corpus(0, args.seed)
+    queries = [frozenset(normalize_ingredients(zipf.sample(rand.randint(1, 3)))) for i in range(args.queries)]
+
+    results = {}
+    for name in args.engines.split(','):
+        before = time.time()
+        engine = recipes.engines[name](recipes.generation().corpus.ingredient_sets())
+        build = time.time() - before
+
+        timings = dict((label, []) for label, _ in SELECTIVITY)
+        for query in queries:
+            before = time.time()
+            found = len(engine.lookup(query))
+            duration = time.time() - before
+            for label, limit in SELECTIVITY:
+                if limit is None or found < limit:
+                    timings[label].append(duration)
+                    break
+
+        results[name] = {'build_s': build}
+        for label, values in timings.items():
+            if values:
+                results[name][label] = percentiles(values)
+    return results
+
+
+def phase_session(args):
+    import cPickle
+    from copy import deepcopy
+    from app.utils.state import encode_state, decode_state
+
+    attributes = {
+        'state': 'search', 'ingredient_list': [u'chicken', u'rice'],
+        'recipe_list': {'query': [u'chicken', u'rice'], 'seed': 2840127365, 'position': 3},
+        'recipe': 12345, 'step': 0, 'confirm_for_restart': False,
+    }
+    formats = {
+        'compact': (encode_state, decode_state),
+        'pickle': (lambda a: cPickle.dumps(deepcopy(a), cPickle.HIGHEST_PROTOCOL), cPickle.loads),
+    }
+
+    results = {}
+    for name, (encode, decode) in formats.items():
+        data = encode(attributes)
+        encoding, decoding = [], []
+        for i in range(args.queries):
+            before = time.time()
+            encode(attributes)
+            encoding.append(time.time() - before)
+            before = time.time()
+            decode(data)
+            decoding.append(time.time() - before)
+        results[name] = {'bytes': len(data), 'encode': percentiles(encoding), 'decode': percentiles(decoding)}
+    return results
+
+
+PHASES = {
+    'build': phase_build,
+    'load': phase_load,
+    'search': phase_search,
+    'session': phase_session,
+}
+
+
+def run_phase(args, phase, store=True):
+    '''
+        Run a phase in a fresh process (clean RSS, nothing cached)
+        returns: its results
+    '''
+    env = dict(os.environ)
+    env['RECIPES_PICKLE'] = args.pickle
+    env['RECIPES_STORE'] = args.store if store else args.store + '.missing'
+
+    command = [sys.executable, os.path.abspath(__file__), '--phase', phase,
+               '--pickle', args.pickle, '--store', args.store, '--seed', str(args.seed),
+               '--queries', str(args.queries), '--engines', args.engines]
+    return json.loads(subprocess.check_output(command, env=env, cwd=ROOT))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=25000, help='number of recipes (e.g. 25000, 250000, 2500000)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--engines', default='index,bitset,scan')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--phase', choices=sorted(PHASES), help=argparse.SUPPRESS)
+    parser.add_argument('--pickle', help=argparse.SUPPRESS)
+    parser.add_argument('--store', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    if args.phase:
+        json.dump(PHASES[args.phase](args), sys.stdout)
+        sys.exit()
+
+    directory = tempfile.mkdtemp()
+    args.pickle = os.path.join(directory, 'recipes.pickle')
+    args.store = os.path.join(directory, 'recipes.store')
+
+    before = time.time()
+    recipes, _ = synthetic_corpus(args.size, args.seed)
+    with open(args.pickle, 'wb') as f:
+        pickle.dump(recipes, f, pickle.HIGHEST_PROTOCOL)
+    del recipes
+    generated = time.time() - before
+    print 'Generated {} recipes in {:.1f} s'.format(args.size, generated)
+
+    results = {
+        'config': {
+            'size': args.size, 'seed': args.seed, 'queries': args.queries,
+            'python': platform.python_version(), 'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'generate_s': generated,
+        'pickle_bytes': os.path.getsize(args.pickle),
+        'build': run_phase(args, 'build', store=False),
+        'load': {
+            'pickle': run_phase(args, 'load', store=False),
+            'store': run_phase(args, 'load'),
+        },
+        'search': run_phase(args, 'search'),
+        'session': run_phase(args, 'session'),
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print json.dumps(results, indent=2, sort_keys=True)
@@ -1,4 +1,6 @@
 import os
+from sqlalchemy.pool import QueuePool
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -6,11 +8,72 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'needs to be changed in any serious situation'
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_RECORD_QUERIES = True
+    SQLALCHEMY_RECORD_QUERIES = False
 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-dev.sqlite')
 
+    # Check that requests are signed by Alexa (turn off to replay requests, see benchmarks/replay.py)
+    ASK_VERIFY_REQUESTS = os.environ.get('ASK_VERIFY_REQUESTS') != 'off'
+
+    # Which engine find_recipes() uses: 'index', 'bitset' or 'scan'
+    SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE') or 'index'
+
+    # Cached search results (number of queries, seconds)
+    SEARCH_CACHE_SIZE = 1024
+    SEARCH_CACHE_TTL = 3600
+
+    # If no recipe has all ingredients offer the SEARCH_RANKED_K recipes
+    # sharing the most ingredients (0 is off), rare ingredients count more with 'idf'
+    SEARCH_RANKED_K = 20
+    SEARCH_RANKED_WEIGHTING = 'idf' # or 'count'
+
+    # Run new searches outside the event loop: None, 'process' or 'thread'
+    SEARCH_OFFLOAD = os.environ.get('SEARCH_OFFLOAD') or None
+    SEARCH_PROCESSES = 2 # per worker
+    SEARCH_TIMEOUT = 2.0 # seconds, waiting and searching
+    SEARCH_MAX_QUEUE = 20 # searches waiting before we refuse new ones
+
+    # Write-behind persistence of the state machine (see app/persistence.py)
+    PERSIST_WRITE_BEHIND = False
+    PERSIST_FLUSH_INTERVAL = 2.0 # seconds
+    PERSIST_FLUSH_SIZE = 100 # dirty users triggering a flush
+    PERSIST_MAX_PENDING = 5000 # requests flush themselves beyond that
+    PERSIST_UPSERT = True # INSERT ... ON CONFLICT if the DB supports it
+
+    # Measure one in METRICS_SAMPLE requests (0 is off), see /metrics
+    # and profile one in METRICS_PROFILE requests (0 is off, goes to the log)
+    METRICS_SAMPLE = 1
+    METRICS_PROFILE = 0
+
+    # PRAGMAs set on every new SQLite connection
+    SQLITE_PRAGMAS = []
+
+    # Per process cache of the user states
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_IDLE = 600 # seconds
+    USER_CACHE_VALIDATE = True # needed with more than one worker
+
+    # Ingredients not in the recipes (e.g. misrecognized, "tomatoe") are replaced by the
+    # most similar ingredient if their trigrams are at least this similar (0 is off)
+    INGREDIENT_MATCH_THRESHOLD = 0.6
+
+    # Users not online for PRUNE_AFTER_DAYS are deleted (with PRUNE_RESET only their state),
+    # using python manage.py prune or every PRUNE_INTERVAL seconds in the background (0 is off)
+    PRUNE_AFTER_DAYS = 180
+    PRUNE_RESET = False
+    PRUNE_INTERVAL = 0
+    PRUNE_BATCH_SIZE = 500 # rows per transaction
+
+    # Recipes kept rendered (speech and cards), see app/dialog.py
+    RENDER_CACHE_SIZE = 512
+
+    # Reload the recipes when the store (or pickle) changed, checked every
+    # CORPUS_RELOAD_INTERVAL seconds (0 is off). Recipes removed since are still
+    # found in the CORPUS_GENERATIONS - 1 previous versions kept in memory.
+    CORPUS_RELOAD_INTERVAL = int(os.environ.get('CORPUS_RELOAD_INTERVAL') or 0)
+    CORPUS_GENERATIONS = 2
+
     @staticmethod
     def init_app(app):
         pass
@@ -18,15 +81,39 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    SQLALCHEMY_RECORD_QUERIES = True
 
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    ASK_VERIFY_REQUESTS = False
 
 
 class ProductionConfig(Config):
-    #SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
-    pass
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+
+    # A small pool per worker, the gevent greenlets share it
+    # (SQLite only, other databases get a QueuePool anyway and reject these connect_args)
+    if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'poolclass': QueuePool,
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': 10,
+            'connect_args': {'check_same_thread': False, 'timeout': 5},
+        }
+
+    # Readers don't block the writer, commits don't wait for fsync (WAL is still safe)
+    SQLITE_PRAGMAS = [
+        # Lets prune_users() shrink the file (only new DBs, see python manage.py prune --vacuum)
+        ('auto_vacuum', 'INCREMENTAL'),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', 5000),
+    ]
+
+    PERSIST_WRITE_BEHIND = True
 
 config = {
     'development': DevelopmentConfig,
@@ -1,9 +1,11 @@
+import os
+
 from flask_script import Manager, Command, Server as _Server, Option
 from flask_script import prompt_bool
 
 from app import create_app, db
 
-app = create_app()
+app = create_app(os.environ.get('FLASK_CONFIG') or 'development')
 manager = Manager(app)
 
 
@@ -23,5 +25,60 @@ def createdb():
         db.drop_all()
         db.create_all()
 
+
+@manager.command
+def buildstore():
+    """Converts recipes.pickle into the memory-mapped recipe store."""
+    import pickle
+    from app.utils.recipes import RECIPES_PICKLE, RECIPES_STORE
+    from app.utils.store import build_store
+
+    recipes = pickle.load(open(RECIPES_PICKLE, 'r'))
+    build_store(recipes, RECIPES_STORE)
+    print 'Stored {} recipes in {}'.format(len(recipes), RECIPES_STORE)
+
+
+@manager.command
+def buildtable():
+    """Precomputes the normalization of all slot values and recipe ingredients, categories and countries."""
+    import codecs
+    from app.utils.recipes import generation
+    from app.utils.normalize import SLOT_VALUES, FACET_VALUES, TABLE, build_table
+
+    corpus = generation().corpus
+    values = set()
+    for path in (SLOT_VALUES,) + FACET_VALUES:
+        values.update(codecs.open(path, 'r', 'utf-8').read().split(u'\n'))
+    for ingredients in corpus.ingredient_sets():
+        values.update(ingredients)
+    for categories, country in corpus.facets():
+        values.update(categories)
+        values.add(country or u'')
+
+    n = build_table(values, TABLE)
+    print 'Normalized {} ingredients into {}'.format(n, TABLE)
+
+
+@manager.command
+def prune(days=None, reset=False, vacuum=False):
+    """Deletes users idle for PRUNE_AFTER_DAYS (--reset: only their state) and shrinks the DB."""
+    from datetime import datetime, timedelta
+    from app.persistence import prune_users, full_vacuum
+
+    days = float(days) if days is not None else app.config['PRUNE_AFTER_DAYS']
+    cutoff = datetime.now() - timedelta(days=days)
+    report = prune_users(cutoff, reset, app.config['PRUNE_BATCH_SIZE'])
+    print '{} {} users not online since {:%Y-%m-%d}'.format('Reset' if reset else 'Deleted', report['rows'], cutoff)
+
+    if report['reclaimed'] is None:
+        return
+    if vacuum:
+        report['reclaimed'] += full_vacuum()
+        report['free'] = 0
+    print 'Reclaimed {} bytes'.format(report['reclaimed'])
+    if report['free']:
+        print '{} bytes are free but stay in the file, convert it once: python manage.py prune --vacuum'.format(report['free'])
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
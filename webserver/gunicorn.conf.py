@@ -0,0 +1,35 @@
+# Gunicorn settings for production, see webserver/gunicorn.sh
+import multiprocessing
+import os
+import random
+
+bind = '127.0.0.1:4999'
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count())
+errorlog = 'gunicorn.log'
+
+# Load the app (recipes, indices) in the master before forking the workers
+preload_app = True
+
+
+def post_fork(server, worker):
+    from app import db
+    from app.wsgi import app
+
+    # Connections must not be shared with the master
+    db.get_engine(app).dispose()
+
+    # Otherwise all workers shuffle the search results the same way
+    random.seed()
+
+
+def post_worker_init(worker):
+    # Warm search processes of this worker (if SEARCH_OFFLOAD = 'process').
+    # Not in post_fork: gevent patches the worker after that, the sockets
+    # and the queue of the pool have to cooperate with the event loop.
+    from app.utils.offload import search_pool
+    search_pool.start()
+
+    # Same for the lock of the write-behind flusher (started on the first save)
+    from app.persistence import state_writer
+    state_writer.start_worker()
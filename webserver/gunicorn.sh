@@ -1,2 +1,2 @@
-# Run gunicorn
-venv/bin/gunicorn -k gevent -w 1 -b 127.0.0.1:4999 --log-file gunicorn.log app.wsgi
\ No newline at end of file
+# Run gunicorn (one gevent worker per core by default, set WEB_CONCURRENCY to change)
+venv/bin/gunicorn -c webserver/gunicorn.conf.py app.wsgi